@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+'''
+Per-step covariance diagnostics of a Kalman filter (KF, EKF, SRKF or the uwb_agent_1p KF) or of
+a KFBank: position standard deviations from the diagonal of P, trace and log-determinant on every
+step, and the principal position standard deviations (symmetric eigensolver on the 3x3 position
+block, get_plot_data) only every eig_every steps. The filter supplies the cheap values through
+get_diagnostics(), all logs are preallocated.
+'''
+
+
+class covarianceLog:
+    def __init__(self, T, eig_every=0, M=None):
+        # T: number of steps, eig_every: decimation of the eigenvalue log (0 = off),
+        # M: number of bank members (logs are (T,M,...) instead of (T,...)), None for a single filter
+        self.eig_every = eig_every
+        shape = (T,) if M is None else (T, M)
+        self.std = np.full(shape + (3,), np.nan)
+        self.trace = np.full(shape, np.nan)
+        self.logdet = np.full(shape, np.nan)
+        self.eig = np.full(shape + (3,), np.nan)
+
+    def record(self, it, kf):
+        self.std[it], self.trace[it], self.logdet[it] = kf.get_diagnostics()
+        if self.eig_every and it % self.eig_every == 0:
+            self.eig[it] = kf.get_plot_data()
+
+    def member(self, m):
+        # Single-filter log of bank member m, its arrays are views into this log
+        log = covarianceLog.__new__(covarianceLog)
+        log.eig_every = self.eig_every
+        log.std, log.trace, log.logdet, log.eig = self.std[:, m], self.trace[:, m], self.logdet[:, m], self.eig[:, m]
+        return log
+
+    def get_logs(self):
+        return self.std, self.trace, self.logdet, self.eig
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import sys
+
+import kalmanFilter as KF
+import particleFilter as PF
+import rbParticleFilter as RBPF
+import shardedParticleFilter as SPF
+
+'''
+Variable-dt prediction: feeds the same jittered timestamps to every filter through predict_to.
+The log also holds repeated and out-of-order timestamps, which have to be skipped without moving
+the filter's time back, so each filter must end exactly where a second copy of it ends after
+being fed only the increasing timestamps. A negative dt passed to predict must be skipped as well.
+Usage: python dt_compare.py [steps]   (default 5000, nominal dt = 0.01)
+'''
+
+ANCHORS = np.array([ [0.0, 0.0, 0.10], [4.0, 0.0, 0.05], [2.0, 3.46, 0.0], [2.0, -3.46, 0.0] ])
+
+
+def timestamps(steps, dt, rng):
+    # Jittered log with every 97th timestamp repeated and every 89th one out of order
+    t = np.arange(steps) * dt + rng.uniform(-0.3, 0.3, steps) * dt
+    for k in range(97, steps, 97):
+        t[k] = t[k - 1]
+    for k in range(89, steps, 89):
+        t[k] = t[k - 1] - 2*dt
+    return t
+
+
+def filters(dt):
+    # name, factory of two identical filters (same seed)
+    xyz, v = np.array([0.5, 0.3, -1.0]), np.zeros(3)
+    return [("KF full", lambda: KF.KF(xyz, v, dt, fast=False)),
+            ("KF fast", lambda: KF.KF(xyz, v, dt, fast=True)),
+            ("SRKF", lambda: KF.SRKF(xyz, v, dt)),
+            ("PF", lambda: PF.particleFilter(v, dt, ANCHORS, rng=np.random.default_rng(1))),
+            ("RBPF", lambda: RBPF.rbParticleFilter(v, dt, ANCHORS, rng=np.random.default_rng(1))),
+            ("sharded PF", lambda: SPF.shardedParticleFilter(v, dt, ANCHORS, N=2000, n_workers=2, rng=np.random.default_rng(1)))]
+
+
+def get_state(f):
+    return f.get_state() if hasattr(f, 'x') else f.estimate()
+
+
+def run(make, t, acc):
+    a, b = make(), make()
+    t_max, back = -np.inf, False
+    for i in range(len(t)):
+        a.predict_to(acc[i], t[i])
+        t_max = max(t_max, t[i])
+        back |= a.t != t_max
+        if t[i] >= t_max and (b.t is None or t[i] > b.t):
+            b.predict_to(acc[i], t[i])
+    before = np.array(get_state(a), dtype=np.float64)
+    a.predict(acc[-1], dt=-0.01)
+    a.predict(acc[-1], dt=0.0)
+    skipped = np.array_equal(before, np.array(get_state(a), dtype=np.float64))
+    diff = np.abs(before - np.array(get_state(b), dtype=np.float64)).max()
+    for f in (a, b):
+        if hasattr(f, 'close'):
+            f.close()
+    return diff, back, skipped
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    dt = 0.01
+    rng = np.random.default_rng(0)
+    t = timestamps(steps, dt, rng)
+    acc = rng.normal(0.0, 0.5, (steps, 3))
+
+    print("%12s %14s %12s %12s" % ("filter", "max |diff|", "time back", "dt<=0 skip"))
+    ok = True
+    for name, make in filters(dt):
+        diff, back, skipped = run(make, t, acc)
+        ok &= diff == 0.0 and not back and skipped
+        print("%12s %14.3e %12s %12s" % (name, diff, back, skipped))
+    print("OK" if ok else "FAILED")
@@ -1,19 +1,53 @@
 #!/usr/bin/env python3
 
+import functools
 import math
 import numpy as np
 import scipy as scipy
 from numpy.random import uniform
 import scipy.stats
+import scipy.linalg
 from filterpy.kalman import KalmanFilter
 from filterpy.common import Q_discrete_white_noise, reshape_z
 import sympy as symp
 
+#Entries of a 6x6 [pos, vel] covariance that belong to the per-axis 2x2 blocks. Flat indexes of the
+#blocks as (pp, pv, vp, vv) of axis 0, 1, 2, and of all other entries
+AXIS_BLOCKS = np.tile(np.eye(3, dtype=bool), (2, 2))
+BLOCK_IDX = np.array([[7*k, 7*k + 3, 18 + 7*k, 21 + 7*k] for k in range(3)]).ravel()
+OFF_BLOCKS = np.flatnonzero(~AXIS_BLOCKS)
+
+#Resolution [s] of the elapsed times of variable-dt predicts, the models are cached per multiple of it
+DT_QUANTUM = 1e-4
+
+
+@functools.lru_cache(maxsize=256)
+def cv_model(ticks, cu):
+    # F, G and Q of the KF model for dt = ticks*DT_QUANTUM and cov_u = cu*I (read-only, shared)
+    dt = ticks * DT_QUANTUM
+    F = np.eye(6)
+    F[0:3, 3:6] = dt * np.eye(3)
+    G = np.vstack(((dt**2)/2 * np.eye(3), dt * np.eye(3)))
+    Q = np.dot(G, G.T) * cu
+    for M in (F, G, Q):
+        M.flags.writeable = False
+    return dt, F, G, Q
+
 
 class KF:
-    def __init__(self, xyz, v_ned, dt, option=0):
+    def __init__(self, xyz, v_ned, dt, option=0, fast=True, steady_state=False, update_every=50, ss_tol=1e-4, sequential=False):
         self.option = option
         self.dt = dt
+        self.fast = fast
+        self.steady = False
+        self.sequential = sequential
+        self.t = None # time of the last predict_to
+
+        #P is held in one 6x6 array for the whole life of the filter (assigning P copies into it), so
+        #in-place writes to kf.P are seen by the filter
+        self.P_buf = np.zeros((6, 6))
+        self.P_flat = self.P_buf.reshape(-1)
+        self.FP_buf = np.empty((6, 6))
 
         if option == 0:
             r = 2.5 #non flat: 0.15 || flat 2.5
@@ -71,14 +105,112 @@ class KF:
         self.K = np.zeros((dim_x, dim_z)) # kalman gain
 
         self.I = np.eye(dim_x)
-        
+
+        #Sequential updates: state index measured by each row of H and the (diagonal) R per row
+        self.H_idx = np.argmax(self.H, axis=1).tolist()
+        self.r_diag = np.diag(self.R).tolist()
+
+        #Process noise of the constant model and F^T, computed once
+        self.Q = np.dot(np.dot(self.G, self.cov_u), self.G.T)
+        self.FT = self.F.T.copy()
+
+        #Steady-state gain mode: the filter runs normally until every entry of its posterior P is within
+        #ss_tol (relative to that entry) of the periodic steady-state solution, then continues on the
+        #stored cycle and only propagates x with the fixed gain. P converges slowly from P0 = 1000 I:
+        #with updates at 2 Hz and dt = 0.01 the switch comes after ~26000 steps for option 0 and ~6150
+        #for option 1, and the state stays within ~1e-4 m (option 0) and ~1e-5 m (option 1) of the full
+        #filter at the default ss_tol. A looser ss_tol switches earlier with a proportionally larger error.
+        self.steady_state = steady_state
+        self.ss_tol = ss_tol
+        self.multi_step = {}
+        if steady_state:
+            self.K_ss, self.P_cycle = self.solve_steady_state(update_every)
+            self.phase = 0
+
         #print("Kalman filter initialized, x_dim: ",self.x.shape, "  f_dim: ", self.F.shape, "  h_dim: ", self.H.shape, "  b_dim: ", self.G.shape)
 
     def get_return_vals(self):
         return self.R[0][0], self.cov_u[0][0]
 
 
-    def predict(self, u):
+    # Fast path: predict with the precomputed F^T and Q into preallocated buffers. F, G, R and cov_u
+    # never couple the axes, so while P is block-diagonal per axis (always, unless a caller writes the
+    # other entries) a position fix is three independent scalar updates of the 2x2 blocks
+    # [[pp, pv], [vp, vv]], read and written back with one gather/scatter of their 12 entries.
+    @property
+    def P(self):
+        if self.steady:
+            #Steady mode does not propagate P, it is the stored periodic solution at the current phase
+            self.P_buf[...] = self.P_cycle[min(self.phase, len(self.P_cycle) - 1)]
+        return self.P_buf
+
+    @P.setter
+    def P(self, P):
+        self.P_buf[...] = P
+
+    def blocked(self):
+        # True when the per-axis update applies
+        return self.fast and not self.P_flat[OFF_BLOCKS].any()
+
+    def solve_steady_state(self, update_every, max_cycles=100000):
+        # Periodic Riccati recursion for one update every update_every predicts, iterated from the
+        # current P until the gain converges. update_every predicts are one step with F^n and the
+        # accumulated Q_n (multi_step_model). Returns the gain and P over one cycle (P_cycle[k]
+        # is P k predicts after the update).
+        Fn, Bn, Qn = self.multi_step_model(update_every)
+
+        P, K = self.P, None
+        for _ in range(max_cycles):
+            K_prev = K
+            PHT = np.dot(P, self.H.T)
+            K = np.dot(PHT, np.linalg.inv(np.dot(self.H, PHT) + self.R))
+            P = np.dot(self.I - np.dot(K, self.H), P)
+            if K_prev is not None and np.abs(K - K_prev).max() <= 1e-12 * np.abs(K).max():
+                break
+            P = np.dot(np.dot(Fn, P), Fn.T) + Qn
+
+        P_cycle = [P]
+        for _ in range(update_every):
+            P_cycle.append(np.dot(np.dot(self.F, P_cycle[-1]), self.F.T) + self.Q)
+        return K, P_cycle
+
+    def multi_step_model(self, k):
+        # k predicts as one linear step, x_k = F^k x + B_k u_seq.ravel() and P_k = F^k P F^k^T + Q_k,
+        # with B_k = [F^(k-1) G, ..., F G, G] and Q_k = sum_i F^i Q F^i^T. Cached per k.
+        if k not in self.multi_step:
+            Fk, Qk, blocks = self.I, np.zeros((6, 6)), []
+            for _ in range(k):
+                blocks.append(np.dot(Fk, self.G))
+                Qk = np.dot(np.dot(self.F, Qk), self.F.T) + self.Q
+                Fk = np.dot(self.F, Fk)
+            self.multi_step[k] = (Fk, np.hstack(blocks[::-1]), Qk)
+        return self.multi_step[k]
+
+    def predict_many(self, u_seq):
+        # Same result as one predict per row of u_seq (k,3), in a single step
+        u_seq = np.asarray(u_seq, dtype=np.float64).reshape(-1, 3)
+        Fk, Bk, Qk = self.multi_step_model(len(u_seq))
+        self.x = np.dot(Fk, self.x) + np.dot(Bk, u_seq.ravel())
+        if self.steady:
+            self.phase += len(u_seq)
+            return
+        self.P = np.dot(np.dot(Fk, self.P), Fk.T) + Qk
+
+    def predict(self, u, dt=None):
+        # dt: elapsed time if it differs from the dt the filter was built with, a dt <= 0 is skipped
+        if dt is not None and dt <= 0:
+            return
+        if dt is not None and dt != self.dt:
+            self.predict_dt(u, dt)
+            return
+        if self.steady:
+            self.x = np.dot(self.F, self.x) + np.dot(self.G, u)
+            self.phase += 1
+            return
+        if self.fast:
+            self.predict_fast(u)
+            return
+
         self.x = np.dot(self.F, self.x) + np.dot(self.G, u)
 
         FP = np.dot(self.F, self.P)
@@ -88,23 +220,257 @@ class KF:
         Q = np.dot(Gcov_u, self.G.T)
 
         self.P = FPFT + Q
-        
 
-    def update(self, z):
+    def predict_dt(self, u, dt):
+        # Predict over an arbitrary elapsed time, with the model of the quantized dt from the cache
+        if dt <= 0:
+            return
+        dt, F, G, Q = cv_model(int(round(dt / DT_QUANTUM)), self.cov_u[0][0])
+        if self.steady:
+            #The periodic steady state no longer holds, continue with the full covariance
+            P = self.P
+            self.steady = False
+            self.P = P
+        if self.fast:
+            self.predict_fast(u, (F, F.T, G, Q))
+            return
+        self.x = np.dot(F, self.x) + np.dot(G, u)
+        self.P = np.dot(np.dot(F, self.P), F.T) + Q
+
+    def predict_to(self, u, t):
+        # Timestamp-driven predict from the time of the previous call to t (the first call only sets the time).
+        # A t at or before the filter's time is skipped and does not move the time back.
+        if self.t is None:
+            self.t = t
+        elif t > self.t:
+            self.predict(u, dt=t - self.t)
+            self.t = t
+
+    def predict_fast(self, u, model=None):
+        # model: (F, F^T, G, Q) of a variable-dt predict, defaults to the filter's own
+        F, FT, G, Q = model if model is not None else (self.F, self.FT, self.G, self.Q)
+        self.x = np.dot(F, self.x) + np.dot(G, u)
+        np.dot(F, self.P_buf, out=self.FP_buf)
+        np.dot(self.FP_buf, FT, out=self.P_buf)
+        self.P_buf += Q
+
+    def update(self, z, mask=None):
+        # mask: (3,) bool of the measured axes (sequential mode), non-finite components are skipped too
         z = np.reshape(z, (3,))
-        PHT = np.dot(self.P, self.H.T)
-        S = np.linalg.inv( np.dot(self.H, PHT) + self.R )
-        self.K = np.dot(PHT, S)
+        full = bool(np.isfinite(z).all()) and (mask is None or bool(np.all(mask)))
+        if self.steady:
+            if full:
+                self.x = self.x + np.dot(self.K_ss, z - np.dot(self.H, self.x))
+                self.phase = 0
+                return
+            #A partial fix breaks the periodic steady state, continue with the full covariance
+            P = self.P
+            self.steady = False
+            self.P = P
+        if self.blocked():
+            self.update_blocks(z, mask)
+        elif self.sequential or not full:
+            self.update_sequential(z, mask)
+        else:
+            P = self.P
+            PHT = np.dot(P, self.H.T)
+            S = np.linalg.inv( np.dot(self.H, PHT) + self.R )
+            self.K = np.dot(PHT, S)
+
+            y = z - np.dot(self.H, self.x)
+            self.x = self.x + np.dot(self.K, y)
+
+            KH = np.dot(self.K, self.H)
+            self.P = np.dot((self.I - KH), P)
+
+        if self.steady_state and full:
+            self.check_steady()
+
+    def check_steady(self):
+        # The posterior after a full fix is the same for the batch, sequential and block update, so all
+        # paths switch to the stored cycle (phase 0 is the posterior) once P is within ss_tol of it.
+        # The entries that are zero in the solution (cross-axis terms) have to stay exactly zero.
+        P0 = self.P_cycle[0]
+        if (np.abs(self.P_buf - P0) <= self.ss_tol * np.abs(P0)).all():
+            self.K = self.K_ss
+            self.steady = True
+            self.phase = 0
+
+    def update_blocks(self, z, mask=None):
+        # Fast path update: a position fix of axis k only touches block k, so the axes are independent
+        # scalar updates (the same result as the batch and the sequential update). Unmeasured or
+        # non-finite axes are skipped.
+        b, x, zl = self.P_flat[BLOCK_IDX].tolist(), self.x.tolist(), z.tolist()
+        for i in range(3):
+            if not math.isfinite(zl[i]) or (mask is not None and not mask[i]):
+                continue
+            pp, pv, vp, vv = b[4*i:4*i+4]
+            s = pp + self.r_diag[i]
+            k0, k1 = pp / s, vp / s
+            y = zl[i] - x[i]
+            x[i] += k0*y
+            x[i+3] += k1*y
+            b[4*i:4*i+4] = pp - k0*pp, pv - k0*pv, vp - k1*pp, vv - k1*pv
+        self.P_flat[BLOCK_IDX] = b
+        self.x = np.array(x)
+
+    def update_sequential(self, z, mask=None):
+        # R is diagonal, so the components can be applied one at a time as scalar updates: a division
+        # and vector operations each, no inverse and no H rebuilt for missing components
+        rows = np.flatnonzero(np.isfinite(z) if mask is None else np.logical_and(mask, np.isfinite(z))).tolist()
+        x, P = self.x.copy(), self.P.copy()
+        for i in rows:
+            j = self.H_idx[i]
+            HP = P[j].copy()
+            K = P[:, j] / (HP[j] + self.r_diag[i])
+            x += K * (z[i] - x[j])
+            P -= np.outer(K, HP)
+        self.x, self.P = x, P
 
-        y = z - np.dot(self.H, self.x)
-        self.x = self.x + np.dot(self.K, y)
 
-        KH = np.dot(self.K, self.H)
-        self.P = np.dot((self.I - KH), self.P)
+    def get_state(self):
+        return self.x
+
+    def get_plot_data(self):
+        # Principal standard deviations of the position
+        return np.sqrt( np.linalg.eigvalsh(self.P[0:3, 0:3]) )
+
+    def get_diagnostics(self):
+        # Position standard deviations, trace and log-determinant of P, without an eigendecomposition
+        if not self.steady and self.blocked():
+            b = self.P_flat[BLOCK_IDX].tolist()
+            std = [math.sqrt(b[i]) for i in range(0, 12, 4)]
+            trace = sum(b[i] + b[i+3] for i in range(0, 12, 4))
+            logdet = sum(math.log(b[i]*b[i+3] - b[i+1]*b[i+2]) for i in range(0, 12, 4))
+            return std, trace, logdet
+        P = self.P
+        d = np.diag(P)
+        return np.sqrt(d[0:3]), d.sum(), np.linalg.slogdet(P)[1]
+
+
+class EKF(KF):
+    '''
+    Tightly coupled range-only EKF (the uwb_agent_1p.KF design for any number of anchors). Same
+    motion model and predict as KF; update takes the raw ranges to the anchors. The Jacobian
+    rows (unit vectors from the anchors) are computed for all anchors at once, then the ranges
+    are applied as sequential scalar updates, so there is no matrix inverse and the cost grows
+    linearly with the number of anchors. Non-finite ranges are skipped.
+    '''
+    def __init__(self, xyz, v_ned, dt, anchors, option=0, range_std=0.04):
+        KF.__init__(self, xyz, v_ned, dt, option=option, fast=False)
+        self.anchors = anchors
+        self.range_var = range_std**2
+
+    def get_return_vals(self):
+        return self.range_var, self.cov_u[0][0]
+
+    def calc_H(self, anchors):
+        # (n,3) position part of the Jacobian and the predicted ranges
+        D = self.x[0:3] - anchors
+        r = np.sqrt(np.einsum('ij,ij->i', D, D))
+        return D / r[:, None], r
+
+    def update(self, z, anchs=0, use4=False):
+        if use4:
+            self.anchors = anchs
+        anchors = np.asarray(self.anchors, dtype=np.float64).reshape(-1, 3)
+        z = np.asarray(z, dtype=np.float64)[:len(anchors)]
+        H, r = self.calc_H(anchors)
+        y = z - r
+
+        x, P = self.x.copy(), self.P.copy()
+        for j in np.flatnonzero(np.isfinite(z)):
+            h = H[j]
+            PHT = np.dot(P[:, 0:3], h)
+            K = PHT / (np.dot(h, PHT[0:3]) + self.range_var)
+            #Innovation against the linearization at the prior, as in one batch EKF update
+            x += K * (y[j] - np.dot(h, x[0:3] - self.x[0:3]))
+            P -= np.outer(K, PHT)
+        self.x, self.P = x, P
+
+
+class SRKF:
+    '''
+    Square-root form of KF (same model, options and interface). The covariance is only held
+    as its Cholesky factor S (P = S S^T), and both steps are QR array algorithms, so P stays
+    symmetric and positive definite by construction. Stable in float32 as well (dtype).
+    '''
+    def __init__(self, xyz, v_ned, dt, option=0, dtype=np.float64):
+        self.option = option
+        self.dt = dt
+        self.dtype = np.dtype(dtype)
+        self.t = None # time of the last predict_to
 
+        kf = KF(xyz, v_ned, dt, option=option, fast=False)
+        self.x = kf.x.astype(self.dtype)
+        self.F, self.G, self.H = kf.F.astype(self.dtype), kf.G.astype(self.dtype), kf.H.astype(self.dtype)
+        self.R, self.cov_u = kf.R, kf.cov_u
+        self.K = np.zeros((6, 3), dtype=self.dtype) # kalman gain
+
+        #Square roots of P, R and G cov_u G^T (the latter as G chol(cov_u), 6x3)
+        self.S = np.linalg.cholesky(kf.P).astype(self.dtype)
+        self.sqrt_R = np.linalg.cholesky(self.R).astype(self.dtype)
+        self.sqrt_Q = np.dot(kf.G, np.linalg.cholesky(self.cov_u)).astype(self.dtype)
+
+        #Pre-array of the update, [[sqrt(R), H S], [0, S]]; only the blocks with S change
+        self.pre = np.zeros((9, 9), dtype=self.dtype)
+        self.pre[0:3, 0:3] = self.sqrt_R
+
+    def get_return_vals(self):
+        return self.R[0][0], self.cov_u[0][0]
+
+    @property
+    def P(self):
+        return np.dot(self.S, self.S.T)
+
+    def predict(self, u, dt=None):
+        # dt: elapsed time if it differs from the dt the filter was built with (model from the cv_model cache),
+        # a dt <= 0 is skipped
+        if dt is not None and dt <= 0:
+            return
+        F, G, sqrt_Q = self.F, self.G, self.sqrt_Q
+        if dt is not None and dt != self.dt:
+            _, F, G, _ = cv_model(int(round(dt / DT_QUANTUM)), self.cov_u[0][0])
+            sqrt_Q = (G * np.sqrt(self.cov_u[0][0])).astype(self.dtype)
+            F, G = F.astype(self.dtype), G.astype(self.dtype)
+        self.x = np.dot(F, self.x) + np.dot(G, np.asarray(u, dtype=self.dtype))
+
+        #[F S, sqrt(Q)] = S' Q^T  ->  P' = F P F^T + G cov_u G^T
+        A = np.hstack((np.dot(F, self.S), sqrt_Q))
+        self.S = np.linalg.qr(A.T, mode='r').T
+
+    def predict_to(self, u, t):
+        # Timestamp-driven predict from the time of the previous call to t (the first call only sets the time).
+        # A t at or before the filter's time is skipped and does not move the time back.
+        if self.t is None:
+            self.t = t
+        elif t > self.t:
+            self.predict(u, dt=t - self.t)
+            self.t = t
+
+    def update(self, z):
+        z = np.reshape(z, (3,)).astype(self.dtype)
+        pre = self.pre
+        pre[0:3, 3:9] = np.dot(self.H, self.S)
+        pre[3:9, 3:9] = self.S
+
+        #Lower-triangular post-array [[sqrt(H P H^T + R), 0], [K sqrt(H P H^T + R), S']]
+        post = np.linalg.qr(pre.T, mode='r').T
+        sqrt_Re, K_bar = post[0:3, 0:3], post[3:9, 0:3]
+        self.S = post[3:9, 3:9].copy()
+
+        y = z - np.dot(self.H, self.x)
+        self.K = scipy.linalg.solve_triangular(sqrt_Re, K_bar.T, trans='T', lower=True).T
+        self.x = self.x + np.dot(K_bar, scipy.linalg.solve_triangular(sqrt_Re, y, lower=True))
 
     def get_state(self):
         return self.x
 
     def get_plot_data(self):
-        return np.sqrt( np.linalg.eig(self.P)[0][0:3] )
+        # Principal standard deviations of the position
+        return np.sqrt( np.linalg.eigvalsh(self.P[0:3, 0:3].astype(np.float64)) )
+
+    def get_diagnostics(self):
+        # diag(P) are the squared row norms of S, log det P = 2 sum log |diag S|
+        d = np.einsum('ij,ij->i', self.S, self.S)
+        return np.sqrt(d[0:3]), d.sum(), 2.0 * np.log(np.abs(np.diag(self.S))).sum()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import kalmanFilter as KF
+import profiler as PR
+
+
+class KFBank:
+    '''
+    M independent Kalman filters (same model and options as kalmanFilter.KF) stored as (M,6)
+    states and (M,6,6) covariances, so predict/update run as batched matmul/solve calls over
+    all members instead of a Python loop per filter.
+    '''
+    def __init__(self, xyz, v_ned, dt, option=0):
+        # xyz, v_ned: (M,3) start position and velocity of every member
+        xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        self.M = xyz.shape[0]
+        self.dt = dt
+
+        #Model matrices from a single KF, so both always share the same tuning
+        kf = KF.KF(np.zeros(3), np.zeros(3), dt, option=option, fast=False)
+        self.F, self.G, self.H, self.R, self.Q = kf.F, kf.G, kf.H, kf.R, kf.Q
+        self.cov_u = kf.cov_u
+        self.I = kf.I
+
+        self.x = np.hstack((xyz, np.broadcast_to(np.asarray(v_ned, dtype=np.float64).reshape(-1, 3), (self.M, 3))))
+        self.P = np.repeat(kf.P[None], self.M, axis=0)
+
+        #TIME HANDLERS (whole bank per call):
+        self.prof = PR.profiler()
+
+    def get_return_vals(self):
+        return self.R[0][0], self.cov_u[0][0]
+
+    def get_time_vals(self):
+        # Per-filter cost, i.e. the bank time amortized over its M members
+        return [self.prof.mean(name) / self.M for name in ['kf_predict', 'kf_upd']]
+
+    @PR.timed('kf_predict')
+    def predict(self, u):
+        # u: (M,3) acceleration per member
+        u = np.asarray(u, dtype=np.float64).reshape(-1, 3)
+        self.x = np.dot(self.x, self.F.T) + np.dot(u, self.G.T)
+        self.P = np.matmul(np.matmul(self.F, self.P), self.F.T) + self.Q
+
+    @PR.timed('kf_upd')
+    def update(self, z, mask=None):
+        # z: (M,3) position measurement per member. mask: (M,) bool, members without a
+        # measurement this epoch are left untouched
+        z = np.asarray(z, dtype=np.float64).reshape(-1, 3)
+        if mask is None:
+            idx = slice(None)
+        else:
+            idx = np.flatnonzero(mask)
+        x, P = self.x[idx], self.P[idx]
+
+        PHT = np.matmul(P, self.H.T)
+        S = np.matmul(self.H, PHT) + self.R
+        #K = PHT S^-1, S is symmetric so K^T = solve(S, PHT^T)
+        K = np.linalg.solve(S, PHT.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+        y = z[idx] - np.dot(x, self.H.T)
+        self.x[idx] = x + np.einsum('mij,mj->mi', K, y)
+        self.P[idx] = np.matmul(self.I - np.matmul(K, self.H), P)
+
+    def get_state(self):
+        return self.x
+
+    def get_plot_data(self):
+        # (M,3) like KF.get_plot_data for every member: principal std devs of the position block
+        return np.sqrt(np.linalg.eigvalsh(self.P[:, 0:3, 0:3]))
+
+    def get_diagnostics(self):
+        # (M,3) position std devs, (M,) trace and (M,) log det of P, like KF.get_diagnostics
+        d = np.diagonal(self.P, axis1=1, axis2=2)
+        return np.sqrt(d[:, 0:3]), d.sum(axis=1), np.linalg.slogdet(self.P)[1]
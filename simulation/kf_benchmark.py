@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import sys
+
+import uwb_agent as range_agent
+
+'''
+KF timing per call: predict as collected by uwb_agent (KFpredict) and the position-fix update, for
+the full 6x6 path, the per-axis fast path, the fast path with sequential scalar updates and the
+steady-state gain mode after batch or sequential updates (timed after the switch to the fixed gain,
+the step of the switch is printed too). The state difference to the full filter is the largest over
+all steps, the covariance difference the one at the end. All filters get the same accelerations and
+the same position fixes at 2 Hz.
+Usage: python kf_benchmark.py [steps]   (default 50000, dt = 0.01)
+'''
+
+
+def run(acc, fixes, dt, **kwargs):
+    agent = range_agent.uwb_agent(ID=10)
+    agent.startKF(np.array([0.5, 0.3, -1.0]), np.zeros(3), dt, **kwargs)
+    steady = None
+    xs = np.empty((len(acc), 6))
+    for i in range(len(acc)):
+        if i % 50 == 0:
+            with agent.prof.span('kf_upd'):
+                agent.UAV_KF.update(z=fixes[i])
+            if agent.UAV_KF.steady and steady is None:
+                #Steady-state mode: time only the fixed-gain steps
+                agent.prof.reset()
+                steady = i
+        agent.KFpredict(acc[i])
+        xs[i] = agent.UAV_KF.x
+    return agent.get_time_vals('KF'), xs, agent.UAV_KF.P, steady
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    dt = 0.01
+    rng = np.random.default_rng(0)
+    acc = rng.normal(0.0, 0.5, (steps, 3))
+    fixes = rng.normal([0.5, 0.3, -1.0], 0.1, (steps, 3))
+
+    modes = [("full", dict(fast=False)), ("fast", dict(fast=True)), ("sequential", dict(fast=True, sequential=True)),
+             ("steady-state", dict(steady_state=True)), ("steady-seq", dict(steady_state=True, sequential=True))]
+    print("%12s %12s %12s %14s %18s %13s" % ("mode", "predict[us]", "update[us]", "max |x diff|", "max |P diff| (rel)",
+                                            "steady after"))
+    for name, kwargs in modes:
+        t, x, P, steady = run(acc, fixes, dt, **kwargs)
+        if name == "full":
+            x_full, P_full = x, P
+        print("%12s %12.2f %12.2f %14.3e %18.3e %13s" % (name, t[0]*1e6, t[1]*1e6, np.abs(x_full - x).max(),
+                                                         np.abs(P_full - P).max() / np.abs(P_full).max(),
+                                                         "-" if steady is None else steady))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import sys
+
+import pycopter as pycopter_class
+import kalmanFilter as KF
+
+'''
+Runs KF, SRKF (float64) and SRKF (float32) side by side on the same pycopter trajectories
+(same accelerations, same position fixes, KF mode of pycopter.run) and reports how far the
+square-root filters drift from KF and how well each covariance keeps its symmetry and
+positive definiteness.
+Usage: python kf_compare.py [n_runs] [tf]   (default 5 runs of 500 s)
+'''
+
+
+def run(seed, tf, dt=0.01):
+    c = pycopter_class.pycopter(tf, dt, seed=seed)
+    filters = None
+    err = np.zeros(3)
+    asym = np.zeros(3)
+    min_eig = np.full(3, np.inf)
+
+    for it in range(len(c.time)):
+        acc_err = c.acc_noise.normal(0, 0.012)
+        if it % 50 == 0:
+            c.range_epoch(it*dt)
+            if filters is not None:
+                fix = c.UAV_agent.calc_pos_alg(use4=False)
+                for f in filters:
+                    f.update(fix)
+                for k, f in enumerate(filters):
+                    P = f.P.astype(np.float64)
+                    asym[k] = max(asym[k], np.abs(P - P.T).max())
+                    min_eig[k] = min(min_eig[k], np.linalg.eigvalsh((P + P.T) / 2).min())
+
+        if filters is None and c.UAV.xyz[2] < -3:
+            filters = [KF.KF(c.UAV.xyz, c.UAV.v_ned, dt, fast=False),
+                       KF.SRKF(c.UAV.xyz, c.UAV.v_ned, dt),
+                       KF.SRKF(c.UAV.xyz, c.UAV.v_ned, dt, dtype=np.float32)]
+        if filters is not None:
+            for f in filters:
+                f.predict(c.UAV.acc + acc_err)
+            x = filters[0].get_state()
+            err[0] = max(err[0], np.linalg.norm(x[0:3] - c.UAV.xyz))
+            err[1] = max(err[1], np.abs(filters[1].get_state() - x).max())
+            err[2] = max(err[2], np.abs(filters[2].get_state() - x).max())
+
+        c.fly()
+        if c.UAV.crashed == 1:
+            break
+    return err, asym, min_eig
+
+
+if __name__ == "__main__":
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    tf = float(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print("%4s %10s %12s %12s %12s %12s %12s %12s" % ("run", "KF err[m]", "SR64-KF", "SR32-KF",
+                                                   "asym KF", "asym SR32", "mineig KF", "mineig SR32"))
+    for i in range(n_runs):
+        err, asym, min_eig = run([0, i], tf)
+        print("%4d %10.3f %12.2e %12.2e %12.2e %12.2e %12.2e %12.2e" % (i, err[0], err[1], err[2], asym[0], asym[2], min_eig[0], min_eig[2]))
@@ -8,6 +8,7 @@ import sys
 import random
 
 import pycopter as pycopter_class
+import profiler as PR
 
 sys.path.append("pycopter/")
 import quadlog
@@ -21,7 +22,7 @@ n_of_sims = 50
 
 
 class logger:
-    def __init__(self, method):
+    def __init__(self, method, seed=0, use_bank=False):
         print("************************* METHOD: ", method, " **************************")
         self.N = n_of_sims
         self.tf = 500
@@ -29,8 +30,14 @@ class logger:
         self.time = np.linspace(0, self.tf, int(self.tf/self.dt))
 
         self.run_animation = False
+        # Run i always uses the random streams of seed [seed, i], so every method sees the same noise
+        self.seed = seed
+        # use_bank: PF, KF and PKF (and their '4' variants) run all n_of_sims simulations in lockstep with one
+        # filter bank. Opt-in: the simulation itself stays per copter and the PF bank predict is bound by the
+        # noise draw, so only the KF bank is clearly faster than the sequential runs
+        self.use_bank = use_bank and method in ('PF', 'PF4', 'KF', 'KF4', 'PKF', 'PKF4')
         #print(sys.argv[1])
-        self.pos_method = method #sys.argv[1] #NF4 = No Filter(4 closest), NF = No filter(svd), KF, KF4 = kalman filter, PF = particle filter, PKF = particle kalman filter
+        self.pos_method = method #sys.argv[1] #NF4 = No Filter(4 closest), NF = No filter(svd), KF, KF4 = kalman filter, EKF, EKF4 = range-only extended kalman filter, PF = particle filter, PKF = particle kalman filter
 
         self.n = int(self.tf/self.dt)
 
@@ -43,20 +50,25 @@ class logger:
 
         if method == 'NF' or method == 'NF4':
             self.big_log_time = np.empty([1, 1, 0])
-        elif method == 'KF' or method == 'KF4':
+        elif method == 'KF' or method == 'KF4' or method == 'EKF' or method == 'EKF4':
             self.big_log_time = np.empty([1, 2, 0])
-        elif method == 'PF' or method == 'PF4' or method == 'PF2':
+        elif method == 'PF' or method == 'PF4' or method == 'PF2' or method == 'RBPF' or method == 'RBPF4':
             self.big_log_time = np.empty([1, 3, 0])
-        elif method == 'PKF' or method == 'PKF4':
-            pass
+        elif method == 'PKF' or method == 'PKF4' or method == 'PKF2':
+            self.big_log_time = np.empty([1, 2, 0])
+        #Timing spans of all runs merged, exported by save_timing
+        self.prof = PR.profiler()
 
         #self.pycopter = pycopter_class.pycopter(self.tf, self.dt)
 
 
     def run_logger(self):
+        if self.use_bank and not self.run_animation:
+            self.run_logger_bank()
+            return
         for i in range(self.N):
             print("Starting simulation #", i+1, " of #", self.N)
-            self.pycopter = pycopter_class.pycopter(self.tf, self.dt)
+            self.pycopter = pycopter_class.pycopter(self.tf, self.dt, seed=[self.seed, i])
             UAV, alg, ed, ed2d, edalt = self.pycopter.run(method=self.pos_method, run_animation=self.run_animation) 
             
             self.big_log_Ed   = np.insert(arr=self.big_log_Ed, obj=i, values=ed, axis=2)
@@ -65,15 +77,35 @@ class logger:
             self.big_log_est  = np.insert(arr=self.big_log_est, obj=i, values=alg, axis=2)
             self.big_log_gt   = np.insert(arr=self.big_log_gt, obj=i, values=UAV, axis=2)
 
-            if self.pos_method == 'PKF' or self.pos_method == 'PKF4' or self.pos_method == 'PKF2':
-                pass
-            else:
-                self.big_log_time = np.insert( arr=self.big_log_time, obj=i, values=self.pycopter.UAV_agent.get_time_vals(self.pos_method), axis=2 )
+            self.big_log_time = np.insert( arr=self.big_log_time, obj=i, values=self.pycopter.UAV_agent.get_time_vals(self.pos_method), axis=2 )
+            self.prof.merge(self.pycopter.UAV_agent.prof)
 
             self.n_of_particles, self.std_add, self.Q, self.R =  self.pycopter.n_of_particles, self.pycopter.std_add, self.pycopter.Q, self.pycopter.R
             del self.pycopter
 
+    def run_logger_bank(self):
+        print("Starting simulations #1-#", self.N, " in lockstep (filter bank)")
+        copters = [pycopter_class.pycopter(self.tf, self.dt, seed=[self.seed, i]) for i in range(self.N)]
+        results, bank = pycopter_class.run_bank(copters, method=self.pos_method)
+
+        for i, (UAV, alg, ed, ed2d, edalt) in enumerate(results):
+            self.big_log_Ed   = np.insert(arr=self.big_log_Ed, obj=i, values=ed, axis=2)
+            self.big_log_Ed2d = np.insert(arr=self.big_log_Ed2d, obj=i, values=ed2d, axis=2)
+            self.big_log_Edalt   = np.insert(arr=self.big_log_Edalt, obj=i, values=edalt, axis=2)
+            self.big_log_est  = np.insert(arr=self.big_log_est, obj=i, values=alg, axis=2)
+            self.big_log_gt   = np.insert(arr=self.big_log_gt, obj=i, values=UAV, axis=2)
+            self.big_log_time = np.insert( arr=self.big_log_time, obj=i, values=bank.get_time_vals(), axis=2 )
+        self.prof.merge(bank.prof)
+
+        self.n_of_particles, self.std_add, self.Q, self.R =  copters[0].n_of_particles, copters[0].std_add, copters[0].Q, copters[0].R
+
     
+    def save_timing(self):
+        # Span statistics (count, total, mean, p50/p95/p99, max) over all runs; with the filter bank
+        # every sample is one call for all n_of_sims members
+        self.prof.to_json('results/'+self.pos_method+'_timing.json', method=self.pos_method, runs=self.N,
+                          members_per_call=self.N if self.use_bank and not self.run_animation else 1)
+
     def calc_statistics(self):
         #Calculate statistics:
         self.Ed_mean  = np.mean(self.big_log_Ed, axis=2)
@@ -112,10 +144,10 @@ class logger:
         
         if method == 'NF' or method == 'NF4':
             info1 = info2 = ''
-        elif method == 'KF' or method == 'KF4':
+        elif method == 'KF' or method == 'KF4' or method == 'EKF' or method == 'EKF4':
             info1 = 'R: ' + str(R)
             info2 = 'Q: ' + str(Q)
-        elif method == 'PF' or method == 'PF4' or method == 'PF2':
+        elif method == 'PF' or method == 'PF4' or method == 'PF2' or method == 'RBPF' or method == 'RBPF4':
             info1 = 'Particles: ' + str(n_of_particles)
             info2 = 'Sigma P: ' + str(std_add)
         elif method == 'PKF' or method == 'PKF4' or method == 'PKF2':
@@ -124,19 +156,16 @@ class logger:
             info3 = 'Particles: ' + str(n_of_particles)
             info4 = 'Sigma P: ' + str(std_add)
 
-        if self.pos_method == 'PKF' or self.pos_method == 'PKF4' or method == 'PKF2':
-            pass
-        else:
-            self.time_mean = np.mean(self.big_log_time, axis=2)
-            self.time_var = np.var(self.big_log_time, axis=2)
-            print("Mean of Operation Time: ", self.time_mean[0])
-            print("Var of Operation Time: ", self.time_var[0])
+        self.time_mean = np.mean(self.big_log_time, axis=2)
+        self.time_var = np.var(self.big_log_time, axis=2)
+        print("Mean of Operation Time: ", self.time_mean[0])
+        print("Var of Operation Time: ", self.time_var[0])
         
         print("Mean of Error(100-400): ", np.mean(self.Ed_mean[10000:40000]))
         print("Mean of Var  (100-400): ", np.mean(self.Ed_var[10000:40000]))
-        if self.pos_method == 'PF' or self.pos_method == 'PF4' or self.pos_method == 'PF2':
+        if self.pos_method == 'PF' or self.pos_method == 'PF4' or self.pos_method == 'PF2' or self.pos_method == 'RBPF' or self.pos_method == 'RBPF4':
             print("N of Particles: ", n_of_particles)
-        elif self.pos_method == 'KF' or self.pos_method == 'KF4':
+        elif self.pos_method == 'KF' or self.pos_method == 'KF4' or self.pos_method == 'EKF' or self.pos_method == 'EKF4':
             print("Q: ", Q)
             print("R: ", R)
         elif self.pos_method == 'PKF' or self.pos_method == 'PKF4' or self.pos_method == 'PKF2':
@@ -258,21 +287,28 @@ class logger:
 if __name__ == "__main__":
     
     c_in = sys.argv[1]
+    # python logger.py <method> bank: lockstep runs with a filter bank (PF, KF, PKF)
+    use_bank = len(sys.argv) > 2 and sys.argv[2] == 'bank'
     if c_in == 'NF':
         method_list = ['NF', 'NF4']
     elif c_in == 'KF':
         method_list = ['KF', 'KF4']
+    elif c_in == 'EKF':
+        method_list = ['EKF', 'EKF4']
     elif c_in == 'PF':
         method_list = ['PF', 'PF4']
     elif c_in == 'PKF':
         method_list = ['PKF', 'PKF4']
+    elif c_in == 'RBPF':
+        method_list = ['RBPF', 'RBPF4']
     elif c_in == '2':
         method_list = ['PF2', 'PKF2']
     
     #method_list = ['NF']
     #method_list = ['NF', 'KF', 'PF']
     for method in method_list:
-        l = logger(method)
+        l = logger(method, use_bank=use_bank)
         l.run_logger()
+        l.save_timing()
         l.calc_statistics()
         l.plot()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import itertools
+import math
+import numpy as np
+import sys
+import time
+
+'''
+Linearized multilateration against a fixed anchor layout (the calc_pos_alg solution).
+
+Subtracting the range equation of anchor 0 from the others gives A x = B with
+    A[i] = p_0 - p_(i+1),   B[i] = q_(i+1) - q_0,   q_i = (r_i^2 - |p_i|^2) / 2
+A only depends on the anchors, so its pseudo-inverse (the inverse for 4 anchors, the
+least-squares solution for more) is computed once per layout and every epoch is B from
+the ranges and one matrix-vector product. Solvers for anchor subsets are cached the same way,
+select picks a subset (closest ranges or lowest GDOP) so a closest-4 fix is a lookup plus one
+matrix-vector product as well.
+
+solve_nls is the nonlinear least-squares fit of the ranges themselves (the calc_pos_MSE
+solution): Levenberg-Marquardt with the analytic Jacobian, vectorized over anchors and epochs.
+A single epoch takes a scalar path instead (3x3 normal equations in closed form on Python floats),
+which avoids the per-call overhead of the small array operations.
+'''
+
+
+def dop(M):
+    # sqrt(trace(M^-1)) of (...,3,3) symmetric M = G^T G, 3x3 inverse in closed form
+    c00 = M[..., 1, 1]*M[..., 2, 2] - M[..., 1, 2]**2
+    c11 = M[..., 0, 0]*M[..., 2, 2] - M[..., 0, 2]**2
+    c22 = M[..., 0, 0]*M[..., 1, 1] - M[..., 0, 1]**2
+    det = M[..., 0, 0]*c00 - M[..., 0, 1]*(M[..., 0, 1]*M[..., 2, 2] - M[..., 1, 2]*M[..., 0, 2]) \
+          + M[..., 0, 2]*(M[..., 0, 1]*M[..., 1, 2] - M[..., 1, 1]*M[..., 0, 2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt((c00 + c11 + c22) / det)
+
+
+class multilateration:
+    def __init__(self, anchors):
+        self.set_anchors(anchors)
+
+    def set_anchors(self, anchors):
+        # (n,3) anchor positions, n >= 4; refactors A
+        self.anchors = np.array(anchors, dtype=np.float64).reshape(-1, 3)
+        self.half_sq = 0.5 * np.einsum('ij,ij->i', self.anchors, self.anchors)
+        self.anchor_list = self.anchors.tolist() #for the single-epoch solve_nls
+        self.A = self.anchors[0] - self.anchors[1:]
+        self.A_pinv = np.linalg.pinv(self.A)
+        #Rank < 3 (e.g. a subset of coplanar anchors) leaves the position unobservable
+        self.rank = np.linalg.matrix_rank(self.A)
+        self.subsets = {}
+        self.combos = {}
+
+    def subset(self, idx):
+        # Cached solver for the anchors with indexes idx
+        idx = tuple(idx)
+        if idx not in self.subsets:
+            self.subsets[idx] = multilateration(self.anchors[list(idx)])
+        return self.subsets[idx]
+
+    def combinations(self, x):
+        # (K,x) index array of all x-anchor subsets, their solvers are built on first use
+        if x not in self.combos:
+            self.combos[x] = np.array(list(itertools.combinations(range(len(self.anchors)), x)))
+            if x >= 4:
+                for idx in self.combos[x]:
+                    self.subset(idx)
+        return self.combos[x]
+
+    def select(self, r, x=4, pos=None):
+        # Sorted indexes of the x anchors with the shortest ranges r, or with pos given the x-subset
+        # with the lowest GDOP at pos. NaN ranges are never picked while x finite ones are left
+        if pos is None:
+            return np.sort(np.argpartition(r, x - 1)[:x])
+        S = self.combinations(x)
+        S = S[np.isfinite(np.asarray(r))[S].all(axis=1)]
+        U = pos - self.anchors
+        U /= np.sqrt(np.einsum('ni,ni->n', U, U))[:, None]
+        V = U[S]
+        return S[np.nanargmin(dop(np.matmul(V.transpose(0, 2, 1), V)))]
+
+    def solve_subset(self, r, x=4, pos=None):
+        # Position from the x anchors picked by select, with the cached solver of that subset (NaN if
+        # those anchors are coplanar)
+        idx = self.select(r, x, pos)
+        return self.subset(idx).solve(np.asarray(r)[idx])
+
+    def solve(self, r):
+        # r: (n,) ranges to the anchors, or (T,n) for T epochs -> (3,) or (T,3) positions, NaN when the
+        # anchors do not fix the position (rank < 3)
+        if self.rank < 3:
+            return np.full(np.shape(r)[:-1] + (3,), np.nan)
+        q = 0.5 * np.square(r) - self.half_sq
+        B = q[..., 1:] - q[..., 0:1]
+        return np.dot(B, self.A_pinv.T)
+
+    def solve_positions(self, R, mask=None):
+        # Batch solve of T epochs. R: (T,n) ranges, mask: (T,n) usable ranges (default: the finite ones).
+        # Rows are grouped by their mask pattern and every group is solved with the cached solver of
+        # its anchor subset, rows with fewer than 4 usable ranges or coplanar anchors are NaN.
+        # Returns positions (T,3), range residuals (T,n) (NaN where masked) and the GDOP of every row.
+        n = len(self.anchors)
+        R = np.asarray(R, dtype=np.float64).reshape(-1, n)
+        valid = np.isfinite(R)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+
+        if valid.all():
+            X = self.solve(R)
+        else:
+            X = np.full((len(R), 3), np.nan)
+            codes = np.dot(valid, 1 << np.arange(n))
+            for code in np.unique(codes):
+                idx = np.flatnonzero((code >> np.arange(n)) & 1)
+                if len(idx) < 4 or self.subset(idx).rank < 3:
+                    continue
+                rows = np.flatnonzero(codes == code)
+                X[rows] = self.subsets[tuple(idx)].solve(R[np.ix_(rows, idx)])
+
+        D = X[:, None, :] - self.anchors
+        dist = np.sqrt(np.einsum('tni,tni->tn', D, D))
+        residuals = np.where(valid, R - dist, np.nan)
+
+        #GDOP = sqrt(trace((G^T G)^-1)) with G the unit vectors to the used anchors
+        U = D * (valid / dist)[:, :, None]
+        gdop = dop(np.matmul(U.transpose(0, 2, 1), U))
+        return X, residuals, gdop
+
+    def nls_terms(self, x, r):
+        # Jacobian (unit vectors from the anchors), range residuals and cost at the (T,3) positions x
+        D = x[:, None, :] - self.anchors
+        dist = np.sqrt(np.einsum('tni,tni->tn', D, D))
+        res = dist - r
+        return D / dist[:, :, None], res, np.einsum('tn,tn->t', res, res)
+
+    def solve_nls(self, r, x0, iters=10, tol=1e-6):
+        # Minimizes sum (|x - p_i| - r_i)^2 from the warm start x0 with at most iters Levenberg-Marquardt
+        # steps (damping lam * I added to J^T J, adapted per epoch).
+        # r: (n,) or (T,n) ranges, x0: (3,) or (T,3) -> (3,) or (T,3) positions
+        r = np.asarray(r, dtype=np.float64)
+        single = r.ndim == 1
+        if single and np.size(x0) == 3:
+            return self.solve_nls_single(r, x0, iters, tol)
+        r = r.reshape(-1, len(self.anchors))
+        x = np.array(np.broadcast_to(x0, (len(r), 3)), dtype=np.float64)
+        lam = np.full(len(r), 1e-3)
+        eye = np.eye(3)
+
+        J, res, cost = self.nls_terms(x, r)
+        for _ in range(iters):
+            JT = J.transpose(0, 2, 1)
+            A = np.matmul(JT, J) + lam[:, None, None] * eye
+            dx = np.linalg.solve(A, -np.matmul(JT, res[:, :, None]))[:, :, 0]
+
+            x_new = x + dx
+            J_new, res_new, cost_new = self.nls_terms(x_new, r)
+            better = cost_new <= cost
+            x = np.where(better[:, None], x_new, x)
+            J = np.where(better[:, None, None], J_new, J)
+            res = np.where(better[:, None], res_new, res)
+            cost = np.where(better, cost_new, cost)
+            lam = np.where(better, lam * 0.1, lam * 10.0)
+            if np.abs(dx).max() < tol:
+                break
+        return x[0] if single else x
+
+    def nls_terms_single(self, x, r):
+        # nls_terms of one epoch on Python floats: Jacobian rows, range residuals and cost
+        x0, x1, x2 = x
+        J, res, cost = [], [], 0.0
+        for (p0, p1, p2), ri in zip(self.anchor_list, r):
+            d0, d1, d2 = x0 - p0, x1 - p1, x2 - p2
+            d = math.sqrt(d0*d0 + d1*d1 + d2*d2)
+            inv = 1.0 / d if d > 0.0 else 0.0
+            e = d - ri
+            J.append((d0*inv, d1*inv, d2*inv))
+            res.append(e)
+            cost += e*e
+        return J, res, cost
+
+    def solve_nls_single(self, r, x0, iters, tol):
+        # solve_nls for one epoch, the same steps with J^T J + lam * I solved in closed form
+        r = r.tolist()
+        x = tuple(np.ravel(x0).tolist())
+        lam = 1e-3
+        J, res, cost = self.nls_terms_single(x, r)
+        for _ in range(iters):
+            a00 = a01 = a02 = a11 = a12 = a22 = b0 = b1 = b2 = 0.0
+            for (j0, j1, j2), e in zip(J, res):
+                a00 += j0*j0; a01 += j0*j1; a02 += j0*j2
+                a11 += j1*j1; a12 += j1*j2; a22 += j2*j2
+                b0 -= j0*e; b1 -= j1*e; b2 -= j2*e
+            a00 += lam; a11 += lam; a22 += lam
+
+            #Symmetric 3x3 inverse via cofactors
+            c00, c01, c02 = a11*a22 - a12*a12, a02*a12 - a01*a22, a01*a12 - a02*a11
+            c11, c12, c22 = a00*a22 - a02*a02, a01*a02 - a00*a12, a00*a11 - a01*a01
+            det = a00*c00 + a01*c01 + a02*c02
+            dx = ((c00*b0 + c01*b1 + c02*b2) / det, (c01*b0 + c11*b1 + c12*b2) / det,
+                  (c02*b0 + c12*b1 + c22*b2) / det)
+
+            x_new = (x[0] + dx[0], x[1] + dx[1], x[2] + dx[2])
+            J_new, res_new, cost_new = self.nls_terms_single(x_new, r)
+            if cost_new <= cost:
+                x, J, res, cost = x_new, J_new, res_new, cost_new
+                lam *= 0.1
+            else:
+                lam *= 10.0
+            if max(abs(dx[0]), abs(dx[1]), abs(dx[2])) < tol:
+                break
+        return np.array(x)
+
+if __name__ == "__main__":
+    # Throughput: python multilateration.py [T]
+    T = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    d = 4.0
+    dy = d * (np.sqrt(3)/2)
+    anchors = np.array([ [0.0, 0.0, 0.10], [d, 0.0, 0.05], [d/2, dy, 0.0], [d/2, -dy, 0.0],
+                         [-(d/2), dy, 0.0], [-d, 0.0, 0.05], [-(d/2), -dy, 0.0] ])
+    rng = np.random.default_rng(0)
+    pos = rng.uniform([-3.0, -3.0, -4.0], [3.0, 3.0, -1.0], (T, 3))
+    R = np.linalg.norm(pos[:, None, :] - anchors, axis=2) + rng.normal(0.0, 0.015, (T, len(anchors)))
+    ml = multilateration(anchors)
+
+    for name, mask in (("all anchors", None), ("10% missing", rng.random(R.shape) > 0.1)):
+        prev_t = time.perf_counter()
+        X, residuals, gdop = ml.solve_positions(R, mask)
+        t = time.perf_counter() - prev_t
+        err = np.linalg.norm(X - pos, axis=1)
+        print("%12s: %8.2f M epochs/s   median error %.3f m   median GDOP %.2f   unsolved rows %d" %
+              (name, T / t * 1e-6, np.nanmedian(err), np.nanmedian(gdop), np.isnan(X[:, 0]).sum()))
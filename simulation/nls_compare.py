@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import scipy.optimize
+import sys
+import time
+
+import uwb_agent as range_agent
+
+'''
+calc_pos_MSE with the old SLSQP fit (scipy.optimize.minimize on uwb_agent.mse) against
+multilateration.solve_nls on the same noisy ranges along a smooth trajectory, both warm-started
+from their previous solution like calc_pos_MSE. Reports the agreement of the two solutions,
+their range cost and time per epoch, then the batched solve_nls throughput over all 7 anchors
+warm-started from the linear (calc_pos_alg) solution.
+Usage: python nls_compare.py [n_epochs]   (default 500)
+'''
+
+
+if __name__ == "__main__":
+    T = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = np.random.default_rng(0)
+    agent = range_agent.uwb_agent(ID=10, d=4.0)
+    anchors = agent.anchors
+
+    #5 Hz range epochs along a circle at 1.5-2.5 m height (NED, z negative)
+    t = np.arange(T) * 0.2
+    pos = np.column_stack((2.0*np.cos(0.2*t), 2.0*np.sin(0.2*t), -2.0 - 0.5*np.sin(0.1*t)))
+    R = np.linalg.norm(pos[:, None, :] - anchors, axis=2) + rng.normal(0.0, 0.03, (T, len(anchors)))
+
+    c, ml3 = anchors[0:3], agent.ml.subset((0, 1, 2))
+    x_slsqp = x_nls = np.array([1.5, 2.0, 0.1])
+    t_slsqp = t_nls = 0.0
+    diff = np.zeros(T)
+    cost = np.zeros((T, 2))
+    for k in range(T):
+        r = R[k, 0:3]
+        prev_t = time.perf_counter()
+        x_slsqp = scipy.optimize.minimize(agent.mse, x_slsqp, args=(c, r), method='SLSQP').x
+        t_slsqp += time.perf_counter() - prev_t
+        prev_t = time.perf_counter()
+        x_nls = ml3.solve_nls(r, x_nls)
+        t_nls += time.perf_counter() - prev_t
+
+        a, b = x_slsqp * [1, 1, -1] if x_slsqp[2] > 0 else x_slsqp, x_nls * [1, 1, -1] if x_nls[2] > 0 else x_nls
+        diff[k] = np.abs(a - b).max()
+        cost[k] = agent.mse(x_slsqp, c, r), agent.mse(x_nls, c, r)
+
+    print("calc_pos_MSE, 3 anchors, %d epochs" % T)
+    print("  SLSQP     %8.1f us/epoch   median range MSE %.2e" % (t_slsqp / T * 1e6, np.median(cost[:, 0])))
+    print("  solve_nls %8.1f us/epoch   median range MSE %.2e" % (t_nls / T * 1e6, np.median(cost[:, 1])))
+    print("  |SLSQP - solve_nls|: median %.2e m, 99%% %.2e m, max %.2e m" %
+          (np.median(diff), np.percentile(diff, 99), diff.max()))
+
+    #Batched: all epochs at once, 7 anchors, warm start from the linear solution
+    x0 = agent.ml.solve(R)
+    prev_t = time.perf_counter()
+    X = agent.ml.solve_nls(R, x0)
+    t_batch = time.perf_counter() - prev_t
+    print("batched solve_nls, 7 anchors: %.2f us/epoch   median error %.3f m (linear %.3f m)" %
+          (t_batch / T * 1e6, np.median(np.linalg.norm(X - pos, axis=1)), np.median(np.linalg.norm(x0 - pos, axis=1))))
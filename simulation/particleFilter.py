@@ -12,11 +12,29 @@ from filterpy.common import Q_discrete_white_noise, reshape_z
 import sympy as symp
 import serial
 import localization as lx
+import pfKernels
+
+
+def bin_keys(pos, bin_size):
+    # One integer key per occupied (bin_size)^3 cell, for counting bins of the posterior
+    ijk = np.floor(pos / bin_size).astype(np.int64) + (1 << 20)
+    return (ijk[:, 0] << 42) | (ijk[:, 1] << 21) | ijk[:, 2]
+
 
 class particleFilter:
-    def __init__(self, start_vel, dt, anchors, option=0):
+    def __init__(self, start_vel, dt, anchors, option=0, N=None, fused=True, log_weights=False, ess_frac=None,
+                 adaptive=False, n_min=300, n_max=None, kld_eps=0.05, kld_z=2.326, bin_size=0.1,
+                 est_method='mean', top_k=None, dtype=np.float64, rng=None, backend=None):
         # option 0 = standalone, option 1 = PKF
         self.option = option
+        # fused = True: all anchors in one vectorized pass (see update_fused)
+        self.fused = fused
+        # log_weights = True: weights are accumulated as log-weights and normalized with log-sum-exp
+        self.log_weights = log_weights
+        # ess_frac: resample_if_needed() only resamples when ESS < ess_frac*N (None = every time)
+        self.ess_frac = ess_frac
+        # backend: pfKernels implementation of the hot loops ('numpy', 'numba', None = best available)
+        self.kern = pfKernels.get_backend(backend)
 
         if option == 0: #PF
             self.N = 1500 #2500
@@ -24,38 +42,145 @@ class particleFilter:
         else: #PKF:
             self.N = 1500 #25000
             self.upd_std_dev = 0.04 #2.2
+        if N is not None:
+            self.N = N
+
+        # adaptive = True: KLD-sampling picks N in [n_min, n_max] at every resample,
+        # starting from n_max for the uniform initialisation box
+        self.adaptive = adaptive
+        self.n_min = n_min
+        self.n_max = n_max if n_max is not None else self.N
+        self.kld_eps, self.kld_z, self.bin_size = kld_eps, kld_z, bin_size
+        if adaptive:
+            self.N = self.n_max
+
+        # est_method: 'mean' (weighted mean), 'topk' (mean of the top_k heaviest particles,
+        # default all but the 200 lightest) or 'map' (weighted mean of the heaviest bin)
+        self.est_method = est_method
+        self.top_k = top_k
+        self.est_cache = None
 
         self.dt = dt
+        self.t = None # time of the last predict_to
         self.anchors = anchors
 
+        # dtype = np.float32 halves the memory traffic of particles, weights and work buffers
+        self.dtype = np.dtype(dtype)
+        # rng: numpy Generator for all draws of this filter, e.g. a randomStreams stream (filled in place with out=)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.sigma_pos, self.sigma_vel = 0.0005, 0.00002
+
         #Init particles and weights
         self.vel_x, self.vel_y, self.vel_z = start_vel
 
-        self.weights = np.full((self.N, 1), 1.0)
-        self.particles = np.zeros((self.N,6))
-        self.particles[:,0] = np.random.uniform(-4.0, 4.0, size=self.N)
-        self.particles[:,1] = np.random.uniform(-4.0, 4.0, size=self.N)
-        self.particles[:,2] = np.random.uniform(-3.5, 0.5, size=self.N)
+        self.weights = np.full((self.N, 1), 1.0/self.N, dtype=self.dtype)
+        self.log_w = np.full(self.N, -np.log(self.N), dtype=self.dtype)
+        self.ess = float(self.N)
+        self.particles = np.zeros((self.N,6), dtype=self.dtype)
+        self.particles[:,0] = self.rng.uniform(-4.0, 4.0, size=self.N)
+        self.particles[:,1] = self.rng.uniform(-4.0, 4.0, size=self.N)
+        self.particles[:,2] = self.rng.uniform(-3.5, 0.5, size=self.N)
         self.particles[:,3] = self.vel_x
         self.particles[:,4] = self.vel_y
         self.particles[:,5] = self.vel_z
+
+        self.alloc_buffers()
         #print("Particle Filter initiated with ", self.N, " Particles")
 
+    def alloc_buffers(self):
+        #Work buffers for predict and the fused update, (re)sized per number of anchors and on every change of N
+        self.dist_buf = np.empty((self.N, len(self.anchors)), dtype=self.dtype)
+        self.sq_buf = np.empty(self.N, dtype=self.dtype)
+        self.ll_buf = np.empty(self.N, dtype=self.dtype)
+        self.noise_buf = np.empty((self.N, 6), dtype=self.dtype)
+        self.step_buf = np.empty((self.N, 3), dtype=self.dtype)
+        self.idx_buf = np.empty(self.N, dtype=np.intp)
+        self.particles_buf = np.empty((self.N, 6), dtype=self.dtype)
+
     def get_return_vals(self):
         return self.N, self.upd_std_dev
 
-    def predict(self, u, v=None):
-        mu, sigma_pos, sigma_vel = 0, 0.0005, 0.00002
-        self.particles[:, :3] += self.particles[:, 3:]*self.dt + u[0]*((self.dt**2)/2) + np.random.normal(mu, sigma_pos, (self.N, 3))
-        self.particles[:, 3:] += u * self.dt + np.random.normal(mu, sigma_vel, (self.N, 3))
+    def predict(self, u, v=None, dt=None):
+        #Constant-acceleration step written into the particle array in place, no temporaries per call.
+        #dt: elapsed time if it differs from self.dt, the noise levels are per self.dt and scale with sqrt(dt).
+        #A dt <= 0 is skipped.
+        if dt is not None and dt <= 0:
+            return
+        self.est_cache = None
+        if dt is None:
+            dt, scale = self.dt, 1.0
+        else:
+            scale = math.sqrt(dt / self.dt)
+        self.rng.standard_normal(out=self.noise_buf, dtype=self.dtype)
+        self.kern.predict(self.particles, np.asarray(u, dtype=self.dtype), dt, self.sigma_pos*scale, self.sigma_vel*scale,
+                          self.noise_buf, self.step_buf)
+
+    def predict_to(self, u, t):
+        # Timestamp-driven predict from the time of the previous call to t (the first call only sets the time).
+        # A t at or before the filter's time is skipped and does not move the time back.
+        if self.t is None:
+            self.t = t
+        elif t > self.t:
+            self.predict(u, dt=t - self.t)
+            self.t = t
+
+    def multi_step_noise(self, k):
+        # Per-axis Cholesky factor (a, b, c) of the position/velocity noise accumulated over k predicts:
+        # pos noise = a*e1, vel noise = b*e1 + c*e2 with e1, e2 standard normals
+        dt, sp2, sv2 = self.dt, self.sigma_pos**2, self.sigma_vel**2
+        var_pos = sp2*k + sv2*dt*dt*(k - 1)*k*(2*k - 1)/6
+        cov = sv2*dt*k*(k - 1)/2
+        var_vel = sv2*k
+        a = np.sqrt(var_pos)
+        b = cov / a
+        return a, b, np.sqrt(var_vel - b*b)
+
+    def predict_many(self, u_seq):
+        # Same distribution as one predict per row of u_seq (k,3), in a single step. The k steps are
+        # linear in the inputs and the noise, so the inputs enter through weighted sums and the
+        # accumulated noise is drawn once from its exact covariance (one (N,6) draw instead of k).
+        self.est_cache = None
+        u_seq = np.asarray(u_seq, dtype=np.float64).reshape(-1, 3)
+        k, dt = len(u_seq), self.dt
+        du_pos = np.dot(dt*dt*(k - np.arange(k) - 0.5), u_seq)
+        du_vel = dt*u_seq.sum(axis=0)
+        a, b, c = self.multi_step_noise(k)
+
+        pos, vel = self.particles[:, :3], self.particles[:, 3:]
+        noise, step = self.noise_buf, self.step_buf
+        self.rng.standard_normal(out=noise, dtype=self.dtype)
+        noise[:, 3:] *= c
+        noise[:, 3:] += b*noise[:, :3]
+        noise[:, 3:] += du_vel
+        noise[:, :3] *= a
+        noise[:, :3] += du_pos
+        np.multiply(vel, k*dt, out=step)
+        step += noise[:, :3]
+        pos += step
+        vel += noise[:, 3:]
 
 
     def update(self, z, anchs=0, use4=False):
+        self.est_cache = None
         if use4:
             self.anchors = anchs
+        if self.fused:
+            self.update_fused(z)
+            return
         p = self.particles
 
+        if self.log_weights:
+            for i, anchor in enumerate(self.anchors):
+                if not np.isfinite(z[i]):
+                    continue
+                est_dist = (((p[:,0] - anchor[0])**2 + (p[:,1]-anchor[1])**2 + (p[:,2]-anchor[2])**2)**0.5)
+                self.log_w += scipy.stats.norm( est_dist, self.upd_std_dev ).logpdf(z[i])
+            self.normalize_log_weights()
+            return
+
         for i, anchor in enumerate(self.anchors):
+            if not np.isfinite(z[i]):
+                continue
             est_dist = (((p[:,0] - anchor[0])**2 + (p[:,1]-anchor[1])**2 + (p[:,2]-anchor[2])**2)**0.5)
             prob = scipy.stats.norm( est_dist, self.upd_std_dev ).pdf(z[i])
             prob = np.resize(prob,(self.N, 1))
@@ -63,20 +188,122 @@ class particleFilter:
 
         self.weights = np.true_divide(self.weights, np.sum(self.weights))
 
+    def update_fused(self, z):
+        # Same Gaussian range likelihood as the per-anchor loop, but the particle-to-anchor
+        # distances and the log-likelihood summed over anchors (constant terms cancel in the
+        # normalization) come from one kernel call into preallocated buffers
+        a = np.ascontiguousarray(self.anchors, dtype=self.dtype).reshape(-1, 3)
+        #Ranges to anchors never heard from (NaN) carry no information and are left out
+        a, z = pfKernels.finite_ranges(a, np.ascontiguousarray(np.asarray(z, dtype=self.dtype)[:a.shape[0]]))
+        n = a.shape[0]
+        if n == 0:
+            return
+        if self.dist_buf.shape != (self.N, n):
+            self.dist_buf = np.empty((self.N, n), dtype=self.dtype)
+        ll = self.ll_buf
+        self.kern.loglik(self.particles, a, z, 0.5 / (self.upd_std_dev**2), ll, self.dist_buf, self.sq_buf)
+
+        if self.log_weights:
+            self.log_w += ll
+            self.normalize_log_weights()
+            return
+
+        #Shift by the max before exp so the product of n_anchors pdfs can not underflow to 0
+        ll -= ll.max()
+        np.exp(ll, out=ll)
+        w = self.weights[:, 0]
+        w *= ll
+        w /= w.sum()
+
+    def normalize_log_weights(self):
+        #log-sum-exp: log_w -= log(sum(exp(log_w))), computed around the max so nothing underflows
+        m = self.log_w.max()
+        self.log_w -= m + np.log(np.sum(np.exp(self.log_w - m)))
+        np.exp(self.log_w, out=self.weights[:, 0])
+
+    def neff(self):
+        #Effective sample size 1/sum(w^2) of the normalized weights
+        w = self.weights[:, 0]
+        self.ess = 1.0 / np.dot(w, w)
+        return self.ess
+
+    def get_ess(self):
+        return self.ess
+
+    def resample_if_needed(self):
+        ess = self.neff()
+        if self.ess_frac is not None and ess >= self.ess_frac * self.N:
+            return False
+        self.resample()
+        return True
+
+    def kld_size(self, k):
+        # Fox' KLD bound: particles needed so the sample-based posterior over k occupied bins
+        # stays within kld_eps (KL divergence) of the true one with probability given by kld_z
+        if k <= 1:
+            return self.n_min
+        a = 2.0 / (9.0 * (k - 1))
+        n = (k - 1) / (2.0 * self.kld_eps) * (1.0 - a + np.sqrt(a) * self.kld_z)**3
+        return int(min(max(np.ceil(n), self.n_min), self.n_max))
+
     def resample(self):
-        indexes = resampling.systematic_resample(self.weights)
-        self.particles[:] = self.particles[indexes]
-        self.weights[:] = self.weights[indexes]
-        self.weights = np.true_divide(self.weights, np.sum(self.weights))
+        self.est_cache = None
+        if self.adaptive:
+            self.resample_kld()
+            return
+        self.kern.systematic_resample(self.weights[:, 0], self.N, self.rng.random(), self.idx_buf)
+        self.kern.gather(self.particles, self.idx_buf, self.particles_buf)
+        self.particles, self.particles_buf = self.particles_buf, self.particles
+        #After systematic resampling every particle carries the same weight
+        self.weights.fill(1.0/self.N)
+        self.log_w.fill(-np.log(self.N))
+
+    def resample_kld(self):
+        w = self.weights[:, 0]
+        self.kern.systematic_resample(w, self.N, self.rng.random(), self.idx_buf)
+        k = np.unique(bin_keys(self.particles[self.idx_buf, :3], self.bin_size)).size
+        n_new = self.kld_size(k)
+        if n_new != self.N:
+            indexes = np.empty(n_new, dtype=np.intp)
+            self.kern.systematic_resample(w, n_new, self.rng.random(), indexes)
+            particles = np.empty((n_new, 6), dtype=self.dtype)
+            self.kern.gather(self.particles, indexes, particles)
+            self.particles = particles
+            self.N = n_new
+            self.alloc_buffers()
+        else:
+            self.kern.gather(self.particles, self.idx_buf, self.particles_buf)
+            self.particles, self.particles_buf = self.particles_buf, self.particles
+        self.weights = np.full((self.N, 1), 1.0/self.N, dtype=self.dtype)
+        self.log_w = np.full(self.N, -np.log(self.N), dtype=self.dtype)
+
+    def estimate(self, method=None):
+        #Cached until the next predict/update/resample, so calling it every sim step is free
+        if method is None:
+            method = self.est_method
+        if self.est_cache is not None and self.est_cache[0] == method:
+            return self.est_cache[1]
+
+        w = self.weights[:, 0]
+        pos = self.particles[:, :3]
+        if method == 'mean':
+            est = np.dot(w, pos) / w.sum()
+        elif method == 'topk':
+            k = self.top_k if self.top_k is not None else max(self.N - 200, 1)
+            k = min(k, self.N)
+            idx = np.argpartition(w, self.N - k)[self.N - k:] #O(N) partial selection
+            est = np.dot(w[idx], pos[idx]) / w[idx].sum()
+        elif method == 'map':
+            #Mode of the posterior: the bin_size^3 cell holding the most weight
+            keys, inv = np.unique(bin_keys(pos, self.bin_size), return_inverse=True)
+            best = np.argmax(np.bincount(inv, weights=w))
+            sel = inv == best
+            est = np.dot(w[sel], pos[sel]) / w[sel].sum()
+        else:
+            raise ValueError("Unknown estimate method: " + str(method))
 
-    def estimate(self):
-        #return np.mean(self.particles, axis=0)
-        #max_idx = np.argmax(self.weights)
-        idx = np.argsort(self.weights)[200:]
-        pos = np.mean(self.particles[idx], axis=0) #DOUBLE CHECK THIS MEAN FUNCTION
-        #print(pos[0, :3])
-        return pos[0, :3]
-        #return self.particles[max_idx]
+        self.est_cache = (method, est)
+        return est
 
     def get_particles(self):
         return self.particles
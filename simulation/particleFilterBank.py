@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import kalmanFilterBank as KFB
+import pfKernels
+import profiler as PR
+
+
+class ParticleFilterBank:
+    '''
+    M independent particle filters (same model as particleFilter, option 0) stored as one
+    (M,N,6) particle tensor with (M,N) weights, so predict/update/resample/estimate run as
+    single vectorized calls over all members instead of a Python loop per filter. Predict and
+    likelihood are the pfKernels batch kernels, so the bank shares its math with particleFilter.
+    The update and resampling amortize well over the members; predict is bound by the one
+    standard_normal draw over the whole (M,N,6) noise buffer, which costs the same per particle
+    as in M separate filters.
+    '''
+    def __init__(self, M, start_vel, dt, anchors, N=1500, upd_std_dev=0.04, ess_frac=None, dtype=np.float64,
+                 rng=None, backend=None):
+        self.M = M
+        self.N = N
+        self.dt = dt
+        self.upd_std_dev = upd_std_dev
+        self.anchors = np.asarray(anchors, dtype=dtype).reshape(-1, 3)
+        self.dtype = np.dtype(dtype)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # ess_frac: resample_if_needed() only resamples the members with ESS < ess_frac*N (None = all, every time)
+        self.ess_frac = ess_frac
+        self.kern = pfKernels.get_backend(backend)
+        self.sigma_pos, self.sigma_vel = 0.0005, 0.00002
+
+        #Init particles and weights, start_vel is (3,) shared or (M,3) per member
+        self.weights = np.full((M, N), 1.0/N, dtype=self.dtype)
+        self.particles = np.zeros((M, N, 6), dtype=self.dtype)
+        self.particles[:, :, 0] = self.rng.uniform(-4.0, 4.0, size=(M, N))
+        self.particles[:, :, 1] = self.rng.uniform(-4.0, 4.0, size=(M, N))
+        self.particles[:, :, 2] = self.rng.uniform(-3.5, 0.5, size=(M, N))
+        self.particles[:, :, 3:] = np.broadcast_to(np.asarray(start_vel, dtype=self.dtype).reshape(-1, 1, 3), (M, N, 3))
+
+        self.noise_buf = np.empty((M, N, 6), dtype=self.dtype)
+        self.step_buf = np.empty((M, N, 3), dtype=self.dtype)
+        self.ll_buf = np.empty((M, N), dtype=self.dtype)
+        self.sq_buf = np.empty((M, N), dtype=self.dtype)
+        self.dist_buf = np.empty((M, N, len(self.anchors)), dtype=self.dtype)
+        self.est_cache = None
+
+        #TIME HANDLERS (whole bank per call):
+        self.prof = PR.profiler()
+
+    def get_return_vals(self):
+        return self.N, self.upd_std_dev
+
+    def get_time_vals(self):
+        # Per-filter cost, i.e. the bank time amortized over its M members
+        return [self.prof.mean(name) / self.M for name in ['pf_predict', 'pf_upd', 'pf_resamp']]
+
+    @PR.timed('pf_predict')
+    def predict(self, u):
+        # u: (M,3) acceleration per member
+        self.est_cache = None
+        self.rng.standard_normal(out=self.noise_buf, dtype=self.dtype)
+        self.kern.predict_batch(self.particles, np.ascontiguousarray(np.asarray(u, dtype=self.dtype).reshape(-1, 3)),
+                                self.dt, self.sigma_pos, self.sigma_vel, self.noise_buf, self.step_buf)
+
+    @PR.timed('pf_upd')
+    def update(self, z, anchors=None, mask=None):
+        # z: (M, n) ranges per member, NaN ranges are skipped. anchors: (n,3) shared or (M,n,3) per member
+        # (closest-n modes), defaults to the bank anchors. mask: (M,) bool, members without a measurement
+        # are left untouched
+        self.est_cache = None
+        M = self.M
+        a = self.anchors if anchors is None else np.asarray(anchors, dtype=self.dtype)
+        n = a.shape[-2]
+        a = np.ascontiguousarray(np.broadcast_to(a, (M, n, 3)), dtype=self.dtype)
+        z = np.ascontiguousarray(np.asarray(z, dtype=self.dtype)[:, :n])
+        if self.dist_buf.shape != (M, self.N, n):
+            self.dist_buf = np.empty((M, self.N, n), dtype=self.dtype)
+
+        ll = self.ll_buf
+        self.kern.loglik_batch(self.particles, a, z, 0.5 / (self.upd_std_dev**2), ll, self.dist_buf, self.sq_buf)
+        ll -= ll.max(axis=1, keepdims=True)
+        np.exp(ll, out=ll)
+        if mask is not None:
+            ll[~np.asarray(mask, dtype=bool)] = 1.0
+
+        self.weights *= ll
+        self.weights /= self.weights.sum(axis=1, keepdims=True)
+
+    def neff(self):
+        return 1.0 / np.einsum('mi,mi->m', self.weights, self.weights)
+
+    def resample_if_needed(self):
+        # Resamples only the members whose ESS dropped below ess_frac*N, returns their indexes
+        if self.ess_frac is None:
+            self.resample()
+            return np.arange(self.M)
+        members = np.flatnonzero(self.neff() < self.ess_frac * self.N)
+        if len(members):
+            self.resample(members)
+        return members
+
+    @PR.timed('pf_resamp')
+    def resample(self, members=None):
+        # Systematic resampling of every member (or only the given ones) with one searchsorted:
+        # row m of the cumulative weights and of the sample positions is shifted by m, so the rows never overlap
+        self.est_cache = None
+        N = self.N
+        w = self.weights if members is None else self.weights[members]
+        M = w.shape[0]
+        rows = np.arange(M)[:, None]
+        positions = (np.arange(N)[None, :] + self.rng.random((M, 1))) / N + rows
+        cumulative_sum = np.cumsum(w, axis=1, dtype=np.float64)
+        bad = ~(cumulative_sum[:, -1] > 0.0) | ~np.isfinite(cumulative_sum[:, -1])
+        if bad.any():
+            bad = np.flatnonzero(bad) if members is None else np.asarray(members)[bad]
+            raise ValueError("Particle weights are NaN or all zero for members " + str(bad))
+        cumulative_sum[:, -1] = 1.0
+        cumulative_sum += rows
+        indexes = np.searchsorted(cumulative_sum.ravel(), positions.ravel(), side='right')
+        indexes = np.minimum(indexes, M*N - 1)
+
+        if members is None:
+            self.particles = self.particles.reshape(M*N, 6)[indexes].reshape(M, N, 6)
+            self.weights.fill(1.0/N)
+        else:
+            self.particles[members] = self.particles[members].reshape(M*N, 6)[indexes].reshape(M, N, 6)
+            self.weights[members] = 1.0/N
+
+    def estimate(self):
+        # (M,3) weighted mean position of every member, cached until the next predict/update/resample
+        if self.est_cache is None:
+            self.est_cache = np.einsum('mi,mij->mj', self.weights, self.particles[:, :, :3])
+        return self.est_cache
+
+    def get_particles(self):
+        return self.particles
+
+
+class PKFBank:
+    '''
+    M PKFs (uwb_agent.startPKF: a particle filter on the ranges, its position estimate fed to a
+    KF with option 1) as one ParticleFilterBank and one KFBank.
+    '''
+    def __init__(self, M, xyz, v_ned, dt, anchors, ess_frac=None, rng=None):
+        self.M = M
+        self.pf = ParticleFilterBank(M, v_ned, dt, anchors, ess_frac=ess_frac, rng=rng)
+        self.kf = KFB.KFBank(xyz, v_ned, dt, option=1)
+
+        #TIME HANDLERS (whole bank per call):
+        self.prof = PR.profiler()
+
+    def get_return_vals(self):
+        return self.kf.get_return_vals() + self.pf.get_return_vals()
+
+    def get_time_vals(self):
+        # Per-filter cost, i.e. the bank time amortized over its M members
+        return [self.prof.mean(name) / self.M for name in ['pkf_predict', 'pkf_upd']]
+
+    @PR.timed('pkf_predict')
+    def predict(self, u):
+        self.kf.predict(u)
+        self.pf.predict(u)
+
+    @PR.timed('pkf_upd')
+    def update(self, z, anchors=None):
+        self.pf.update(z, anchors)
+        self.pf.resample_if_needed()
+        self.kf.update(self.pf.estimate())
+
+    def get_state(self):
+        return self.kf.get_state()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Particle filter hot-loop kernels with interchangeable backends:
+
+    predict(particles, u, dt, sigma_pos, sigma_vel, noise, step)
+    loglik(particles, anchors, z, scale, out, dist_buf, sq_buf)
+    systematic_resample(weights, n, u0, out)
+    gather(src, indexes, out)
+
+predict_batch and loglik_batch are the same two steps for a bank of M filters: (M,N,6)
+particles, (M,3) inputs, (M,n,3) anchors and (M,n) ranges (particleFilterBank). Non-finite
+ranges (anchors a member never heard from) are left out of that member's likelihood.
+
+'numpy' is always available. 'numba' JIT-compiles single-pass loops over the particles
+(no intermediate arrays) and is picked at import time when numba is installed. Its float
+flags are fastmath minus nnan/ninf, so NaN and inf propagate as in numpy instead of being
+undefined. systematic_resample raises ValueError on NaN or all-zero weights.
+'''
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#fastmath=True without the no-NaN/no-inf assumptions
+FASTMATH = {'reassoc', 'contract', 'arcp', 'nsz', 'afn'}
+
+
+def finite_ranges(anchors, z):
+    # Anchors and ranges without the non-finite ranges (anchors never heard from)
+    valid = np.isfinite(z)
+    if valid.all():
+        return anchors, z
+    return np.ascontiguousarray(anchors[valid]), np.ascontiguousarray(z[valid])
+
+
+class numpyKernels:
+    name = 'numpy'
+
+    @staticmethod
+    def predict(particles, u, dt, sigma_pos, sigma_vel, noise, step):
+        # noise: (N,6) standard normals, step: (N,3) scratch
+        pos, vel = particles[..., :3], particles[..., 3:]
+        np.multiply(vel, dt, out=step)
+        step += u * ((dt**2)/2)
+        noise[..., :3] *= sigma_pos
+        step += noise[..., :3]
+        pos += step
+        noise[..., 3:] *= sigma_vel
+        noise[..., 3:] += u * dt
+        vel += noise[..., 3:]
+
+    @staticmethod
+    def predict_batch(particles, u, dt, sigma_pos, sigma_vel, noise, step):
+        # noise: (M,N,6), step: (M,N,3)
+        numpyKernels.predict(particles, u[:, None, :], dt, sigma_pos, sigma_vel, noise, step)
+
+    @staticmethod
+    def loglik(particles, anchors, z, scale, out, dist_buf, sq_buf):
+        # out[i] = -scale * sum_j (|p_i - a_j| - z_j)^2, using |p - a|^2 = |p|^2 - 2 p.a + |a|^2
+        pos = particles[:, :3]
+        D = dist_buf
+        np.dot(pos, anchors.T, out=D)
+        D *= -2.0
+        np.einsum('ij,ij->i', pos, pos, out=sq_buf)
+        D += sq_buf[:, None]
+        D += np.einsum('ij,ij->i', anchors, anchors)
+        np.maximum(D, 0.0, out=D)
+        np.sqrt(D, out=D)
+        D -= z
+        np.square(D, out=D)
+        np.sum(D, axis=1, out=out)
+        out *= -scale
+
+    @staticmethod
+    def loglik_batch(particles, anchors, z, scale, out, dist_buf, sq_buf):
+        # out: (M,N), dist_buf: (M,N,n), sq_buf: (M,N)
+        pos = particles[..., :3]
+        D = dist_buf
+        np.matmul(pos, anchors.transpose(0, 2, 1), out=D)
+        D *= -2.0
+        np.einsum('mij,mij->mi', pos, pos, out=sq_buf)
+        D += sq_buf[:, :, None]
+        D += np.einsum('mij,mij->mi', anchors, anchors)[:, None, :]
+        np.maximum(D, 0.0, out=D)
+        np.sqrt(D, out=D)
+        D -= z[:, None, :]
+        np.square(D, out=D)
+        valid = np.isfinite(z)
+        if not valid.all():
+            np.copyto(D, 0.0, where=~valid[:, None, :])
+        np.sum(D, axis=2, out=out)
+        out *= -scale
+
+    @staticmethod
+    def systematic_resample(weights, n, u0, out):
+        positions = (np.arange(n) + u0) / n
+        cumulative_sum = np.cumsum(weights)
+        if not cumulative_sum[-1] > 0.0 or not np.isfinite(cumulative_sum[-1]):
+            raise ValueError("Particle weights are NaN or all zero")
+        cumulative_sum[-1] = 1.0
+        np.minimum(np.searchsorted(cumulative_sum, positions, side='right'), len(weights) - 1, out=out)
+
+    @staticmethod
+    def gather(src, indexes, out):
+        np.take(src, indexes, axis=0, out=out)
+
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=FASTMATH)
+    def _nb_predict(particles, u, dt, sigma_pos, sigma_vel, noise, step):
+        half_dt2 = 0.5 * dt * dt
+        for i in range(particles.shape[0]):
+            for k in range(3):
+                v = particles[i, 3+k]
+                particles[i, k] += v*dt + u[k]*half_dt2 + sigma_pos*noise[i, k]
+                particles[i, 3+k] = v + u[k]*dt + sigma_vel*noise[i, 3+k]
+
+    @numba.njit(cache=True, fastmath=FASTMATH)
+    def _nb_loglik(particles, anchors, z, scale, out, dist_buf, sq_buf):
+        for i in range(particles.shape[0]):
+            x, y, h = particles[i, 0], particles[i, 1], particles[i, 2]
+            acc = 0.0
+            for j in range(anchors.shape[0]):
+                dx, dy, dz = x - anchors[j, 0], y - anchors[j, 1], h - anchors[j, 2]
+                r = np.sqrt(dx*dx + dy*dy + dz*dz) - z[j]
+                acc += r*r
+            out[i] = -scale * acc
+
+    @numba.njit(cache=True)
+    def _nb_predict_batch(particles, u, dt, sigma_pos, sigma_vel, noise, step):
+        for m in range(particles.shape[0]):
+            _nb_predict(particles[m], u[m], dt, sigma_pos, sigma_vel, noise[m], step[m])
+
+    @numba.njit(cache=True)
+    def _nb_loglik_batch(particles, anchors, z, scale, out, dist_buf, sq_buf):
+        for m in range(particles.shape[0]):
+            for i in range(particles.shape[1]):
+                x, y, h = particles[m, i, 0], particles[m, i, 1], particles[m, i, 2]
+                acc = 0.0
+                for j in range(anchors.shape[1]):
+                    if not np.isfinite(z[m, j]):
+                        continue
+                    dx, dy, dz = x - anchors[m, j, 0], y - anchors[m, j, 1], h - anchors[m, j, 2]
+                    r = np.sqrt(dx*dx + dy*dy + dz*dz) - z[m, j]
+                    acc += r*r
+                out[m, i] = -scale * acc
+
+    @numba.njit(cache=True)
+    def _nb_systematic_resample(weights, n, u0, out):
+        # Merge of the n sorted positions with the running cumulative sum, O(N + n)
+        m = weights.shape[0]
+        total = 0.0
+        for j in range(m):
+            total += weights[j]
+        if not total > 0.0 or not np.isfinite(total):
+            raise ValueError("Particle weights are NaN or all zero")
+        j = 0
+        cumulative = weights[0]
+        for i in range(n):
+            position = (i + u0) / n
+            while position >= cumulative and j < m - 1:
+                j += 1
+                cumulative += weights[j]
+            out[i] = j
+
+    @numba.njit(cache=True)
+    def _nb_gather(src, indexes, out):
+        for i in range(indexes.shape[0]):
+            for k in range(src.shape[1]):
+                out[i, k] = src[indexes[i], k]
+
+    class numbaKernels:
+        name = 'numba'
+        predict = staticmethod(_nb_predict)
+        loglik = staticmethod(_nb_loglik)
+        predict_batch = staticmethod(_nb_predict_batch)
+        loglik_batch = staticmethod(_nb_loglik_batch)
+        systematic_resample = staticmethod(_nb_systematic_resample)
+        gather = staticmethod(_nb_gather)
+
+
+BACKENDS = {'numpy': numpyKernels}
+if numba is not None:
+    BACKENDS['numba'] = numbaKernels
+DEFAULT_BACKEND = 'numba' if numba is not None else 'numpy'
+
+
+def get_backend(name=None):
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError("Kernel backend not available: " + str(name))
+    return BACKENDS[name]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import sys
+import time
+
+import pfKernels
+
+'''
+Compares the pfKernels backends on the particle filter hot loops.
+Usage: python pf_benchmark.py [N ...]   (default N = 1500 10000 100000)
+'''
+
+REPEATS = 20
+
+
+def setup(N, n_anchors=7):
+    d = 4.0
+    dy = d * (np.sqrt(3)/2)
+    anchors = np.array([ [0.0, 0.0, 0.10], [d, 0.0, 0.05], [d/2, dy, 0.0], [d/2, -dy, 0.0],
+                         [-(d/2), dy, 0.0], [-d, 0.0, 0.05], [-(d/2), -dy, 0.0] ])[:n_anchors]
+    rng = np.random.default_rng(0)
+    particles = np.zeros((N, 6))
+    particles[:, :2] = rng.uniform(-4.0, 4.0, (N, 2))
+    particles[:, 2] = rng.uniform(-3.5, 0.5, N)
+    z = np.linalg.norm(anchors - np.array([0.5, 0.3, -1.0]), axis=1)
+    weights = rng.random(N)
+    weights /= weights.sum()
+    return particles, anchors, z, weights
+
+
+def time_call(f, *args):
+    f(*args) #warm-up, includes JIT compilation
+    prev_t = time.perf_counter()
+    for _ in range(REPEATS):
+        f(*args)
+    return (time.perf_counter() - prev_t) / REPEATS
+
+
+def bench(kern, N):
+    particles, anchors, z, weights = setup(N)
+    u = np.array([0.1, -0.2, 0.05])
+    noise = np.random.default_rng(1).standard_normal((N, 6))
+    step = np.empty((N, 3))
+    ll = np.empty(N)
+    dist_buf = np.empty((N, len(anchors)))
+    sq_buf = np.empty(N)
+    idx = np.empty(N, dtype=np.intp)
+    out = np.empty((N, 6))
+
+    return [ time_call(kern.predict, particles, u, 0.01, 0.0005, 0.00002, noise, step),
+             time_call(kern.loglik, particles, anchors, z, 0.5/0.04**2, ll, dist_buf, sq_buf),
+             time_call(kern.systematic_resample, weights, N, 0.5, idx),
+             time_call(kern.gather, particles, idx, out) ]
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [1500, 10000, 100000]
+    print("Backends available: ", list(pfKernels.BACKENDS), " default: ", pfKernels.DEFAULT_BACKEND)
+    print("%8s %8s %12s %12s %12s %12s" % ("N", "backend", "predict[us]", "loglik[us]", "resamp[us]", "gather[us]"))
+    for N in sizes:
+        for name, kern in pfKernels.BACKENDS.items():
+            t = bench(kern, N)
+            print("%8d %8s %12.1f %12.1f %12.1f %12.1f" % ((N, name) + tuple(x*1e6 for x in t)))
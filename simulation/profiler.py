@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import functools
+import json
+import math
+import numpy as np
+import time
+
+'''
+Named timing spans for the estimators (NF, KF, PF, PKF and the filter banks).
+
+Every span keeps count, total and max of its perf_counter_ns durations plus a histogram over
+fixed log-spaced buckets (BUCKETS_PER_OCTAVE per power of two, 1 ns to 2^40 ns), so memory stays
+constant however long the run and the summary can still report the tail (p50/p95/p99, within
+half a bucket, about 4%) next to the mean: the spikes that matter on the flight computer
+disappear in a mean. Profilers of several runs are merged into one (logger) and exported as JSON.
+A disabled profiler hands out one shared no-op context manager, so the instrumentation stays in
+place at next to no cost.
+'''
+
+BUCKETS_PER_OCTAVE = 8
+N_BUCKETS = 40 * BUCKETS_PER_OCTAVE
+
+
+def bucket(ns):
+    # Histogram bucket of a duration in ns: bucket k holds [2^(k/B), 2^((k+1)/B)) with B = BUCKETS_PER_OCTAVE
+    if ns < 1:
+        return 0
+    return min(int(math.log2(ns) * BUCKETS_PER_OCTAVE), N_BUCKETS - 1)
+
+
+def bucket_value(k):
+    # Representative duration (geometric centre) of bucket k in ns
+    return 2.0 ** ((k + 0.5) / BUCKETS_PER_OCTAVE)
+
+
+class nullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = nullSpan()
+
+
+class span:
+    # The start times live on a stack, so one span can be entered again before it exits
+    # (nested or recursive calls of the same name), every exit pairs with the latest enter
+    __slots__ = ('buckets', 'count', 'total', 'max', 'starts')
+
+    def __init__(self):
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(time.perf_counter_ns())
+        return self
+
+    def __exit__(self, *exc):
+        self.record(time.perf_counter_ns() - self.starts.pop())
+        return False
+
+    def record(self, ns):
+        self.buckets[bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        # Duration in ns below which a fraction q of the calls fall, from the cumulative bucket counts
+        target = q * self.count
+        cumulative = 0
+        for k, c in enumerate(self.buckets):
+            cumulative += c
+            if c and cumulative >= target:
+                return min(bucket_value(k), self.max)
+        return self.max
+
+
+class profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = {}
+
+    def span(self, name):
+        # Context manager timing one call of the named span
+        if not self.enabled:
+            return NULL_SPAN
+        s = self.spans.get(name)
+        if s is None:
+            s = self.spans[name] = span()
+        return s
+
+    def timed(self, name):
+        # Function decorator version of span
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, ns):
+        # Externally measured duration(s) in ns
+        if self.enabled:
+            s = self.spans.setdefault(name, span())
+            for v in np.atleast_1d(ns).tolist():
+                s.record(int(v))
+
+    def merge(self, other):
+        # Adds the histograms of another profiler (e.g. the next simulation run)
+        for name, s in other.spans.items():
+            self.spans.setdefault(name, span()).merge(s)
+
+    def reset(self):
+        self.spans = {}
+
+    def count(self, name):
+        return self.spans[name].count if name in self.spans else 0
+
+    def mean(self, name):
+        # Mean duration in seconds (NaN for a span that never ran)
+        if not self.count(name):
+            return np.nan
+        s = self.spans[name]
+        return s.total / s.count * 1e-9
+
+    def stats(self, name):
+        # Count, total and mean, p50/p95/p99 (histogram estimates) and max of one span, durations in seconds
+        s = self.spans.get(name)
+        if s is None or not s.count:
+            return {'count': 0}
+        return {'count': s.count, 'total': s.total * 1e-9, 'mean': s.total / s.count * 1e-9,
+                'p50': s.percentile(0.50) * 1e-9, 'p95': s.percentile(0.95) * 1e-9,
+                'p99': s.percentile(0.99) * 1e-9, 'max': s.max * 1e-9}
+
+    def summary(self):
+        return {name: self.stats(name) for name in sorted(self.spans)}
+
+    def to_json(self, path=None, **extra):
+        # Summary (plus any extra fields) as a JSON string, also written to path if given. Every span
+        # also lists its nonzero histogram buckets as [lower edge in ns, count]
+        spans = self.summary()
+        for name, s in self.spans.items():
+            spans[name]['buckets'] = [[2.0 ** (k / BUCKETS_PER_OCTAVE), c] for k, c in enumerate(s.buckets) if c]
+        data = dict(extra, buckets_per_octave=BUCKETS_PER_OCTAVE, spans=spans)
+        text = json.dumps(data, indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+def timed(name):
+    # Method decorator: times the call in the span name of the instance's profiler (self.prof)
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if not self.prof.enabled:
+                return f(self, *args, **kwargs)
+            with self.prof.span(name):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -12,6 +12,10 @@ import csv
 from filterpy.kalman import KalmanFilter
 from filterpy.common import Q_discrete_white_noise
 import uwb_agent as range_agent
+import particleFilterBank as PFB
+import kalmanFilterBank as KFB
+import randomStreams as RS
+import covarianceLog as CL
 
 sys.path.append("pycopter/")
 import quadrotor as quad
@@ -22,7 +26,7 @@ import animation as ani
 PI = 3.14159265359
 
 class pycopter:
-    def __init__(self, tf=500, dt=0.02):
+    def __init__(self, tf=500, dt=0.02, seed=None):
         m = 0.65 # Kg
         l = 0.23 # m
         Jxx = 7.5e-3 # Kg/m^2
@@ -111,7 +115,9 @@ class pycopter:
         self.Ed2d_log = np.zeros((self.time.size, 1))
         self.Edalt_log = np.zeros((self.time.size, 1))
         self.Ed_vel_log = np.zeros((self.time.size, 1))
-        self.eig_log = np.zeros((self.time.size, 3))
+        #Kalman covariance diagnostics on every step, principal position std devs at every range epoch
+        self.cov_log = CL.covarianceLog(self.time.size, eig_every=50)
+        self.eig_log = self.cov_log.eig
 
         self.RA0 = range_agent.uwb_agent( ID=0 )
         self.RA1 = range_agent.uwb_agent( ID=1 )
@@ -125,12 +131,17 @@ class pycopter:
 
         self.R = self.Q = self.n_of_particles = self.std_add = 0.0
 
+        # Random streams: one per noise source, all derived from seed (None = fresh entropy)
+        self.streams = RS.randomStreams(seed)
+        self.range_noise = self.streams.block('range')
+        self.acc_noise = self.streams.block('acc')
+
     def get_dist_clean(self, p1, p2):
         return (np.linalg.norm(p1 - p2))
 
     def get_dist(self, p1, p2):
         mu, sigma = 0, 0.015
-        std_err = np.random.normal(mu, sigma, 1)[0]
+        std_err = self.range_noise.normal(mu, sigma)
         '''
         with open('sim_std_err.csv', mode='a') as writeFile:
             writer = csv.writer(writeFile, delimiter=',')
@@ -142,9 +153,18 @@ class pycopter:
 
     def run(self, method, run_animation=False):
         if not (method == 'NF' or method == 'KF' or method == 'PF' or method == 'PKF' or \
-                method == 'NF4' or method == 'KF4' or method == 'PF4' or method == 'PKF4' or method == 'PF2' or method == 'PKF2'):
+                method == 'NF4' or method == 'KF4' or method == 'PF4' or method == 'PKF4' or method == 'PF2' or method == 'PKF2' or \
+                method == 'RBPF' or method == 'RBPF4' or method == 'EKF' or method == 'EKF4'):
             print ("Wrong Input, your in put was: ", method)
             return -1
+        #RBPF = Rao-Blackwellized particle filter, runs through the PF branch
+        rao_blackwell = method[0:2] == 'RB'
+        if rao_blackwell:
+            method = method[2:]
+        #EKF = range-only extended Kalman filter, runs through the KF branch
+        extended = method[0:2] == 'EK'
+        if extended:
+            method = method[1:]
         use = 4
         use4 = False
         if len(method) > 2:
@@ -174,22 +194,18 @@ class pycopter:
         frames = self.frames
 
         for t in self.time:
-            acc_err = np.random.normal(0, 0.012, 1)[0]
+            acc_err = self.acc_noise.normal(0, 0.012)
             #HANDLE RANGE MEASUREMENTS:
             if it % 50 == 0 or it == 0: # or method == 'NF':
                 #print(t)
-                self.UAV_agent.handle_range_msg(self.RA0.id, self.get_dist(self.UAV.xyz, self.uwb0.xyz))
-                self.UAV_agent.handle_range_msg(self.RA1.id, self.get_dist(self.UAV.xyz, self.uwb1.xyz))
-                self.UAV_agent.handle_range_msg(self.RA2.id, self.get_dist(self.UAV.xyz, self.uwb2.xyz))
-                self.UAV_agent.handle_range_msg(self.RA3.id, self.get_dist(self.UAV.xyz, self.uwb3.xyz))
-                self.UAV_agent.handle_range_msg(self.RA4.id, self.get_dist(self.UAV.xyz, self.uwb4.xyz))
-                self.UAV_agent.handle_range_msg(self.RA5.id, self.get_dist(self.UAV.xyz, self.uwb5.xyz))
-                self.UAV_agent.handle_range_msg(self.RA6.id, self.get_dist(self.UAV.xyz, self.uwb6.xyz))
+                self.range_epoch(it*dt)
                 if PFstarted and method == 'PF':
                     self.UAV_agent.PFupdate(use4=use4, use=use)
                 if PKFstarted and method == 'PKF':
                     self.UAV_agent.updatePKF(use4=use4, use=use)
-                if kalmanStarted and method == 'KF':
+                if kalmanStarted and method == 'KF' and extended:
+                    self.UAV_agent.EKFupdate(use4=use4, use=use)
+                elif kalmanStarted and method == 'KF':
                     alg_pos = self.UAV_agent.calc_pos_alg(use4=use4)
 
 
@@ -200,13 +216,17 @@ class pycopter:
             
             #HANDLE KALMAN FILTER:
             if method == 'KF':
-                if self.UAV.xyz[2] < -3 and not kalmanStarted:
+                if self.UAV.xyz[2] < -3 and not kalmanStarted and extended:
+                    self.R, self.Q = self.UAV_agent.startEKF(self.UAV.xyz, v_ned=self.UAV.v_ned, dt=dt)
+                    kalmanStarted = True
+                elif self.UAV.xyz[2] < -3 and not kalmanStarted:
                     self.R, self.Q = self.UAV_agent.startKF(self.UAV.xyz, v_ned=self.UAV.v_ned, dt=dt)
                     kalmanStarted = True
                 
                 if kalmanStarted:
                     self.UAV_agent.KFpredict( self.UAV.acc + acc_err )
                     alg_pos = self.UAV_agent.get_kf_state()
+                    self.cov_log.record(it, self.UAV_agent.UAV_KF)
                 else:
                     alg_pos = self.UAV_agent.calc_pos_alg(use4=use4)
                 
@@ -214,7 +234,7 @@ class pycopter:
             #HANDLE PARTICLE FILTER
             if method == 'PF':
                 if self.UAV.xyz[2] < -3 and not PFstarted:
-                    self.n_of_particles, self.std_add =  self.UAV_agent.startPF(start_vel=self.UAV.v_ned, dt=dt)
+                    self.n_of_particles, self.std_add =  self.UAV_agent.startPF(start_vel=self.UAV.v_ned, dt=dt, rao_blackwell=rao_blackwell, rng=self.streams.generator('pf'))
                     PFstarted = True
 
                 if PFstarted:
@@ -227,11 +247,12 @@ class pycopter:
             #HANDLE PARTICLE KALMAN FILTER
             if method == 'PKF':
                 if self.UAV.xyz[2] < -3 and not PKFstarted:
-                    self.R, self.Q, self.n_of_particles, self.std_add = self.UAV_agent.startPKF(self.UAV.acc + acc_err, dt=dt, xyz=self.UAV.xyz, v_ned=self.UAV.v_ned)
+                    self.R, self.Q, self.n_of_particles, self.std_add = self.UAV_agent.startPKF(self.UAV.acc + acc_err, dt=dt, xyz=self.UAV.xyz, v_ned=self.UAV.v_ned, rng=self.streams.generator('pf'))
                     PKFstarted = True
                 if PKFstarted:
                     alg_pos = self.UAV_agent.get_PKFstate()
                     self.UAV_agent.predictPKF(self.UAV.acc + acc_err)
+                    self.cov_log.record(it, self.UAV_agent.UAV_KF)
                 else:
                     alg_pos = self.UAV.xyz
 
@@ -239,42 +260,10 @@ class pycopter:
             #print("True pos:     ",self.UAV.xyz)
 
             #HANDLE UAV MOVEMENT:
-            x_err = abs(self.wp[self.state][0] - self.UAV.xyz[0])
-            y_err = abs(self.wp[self.state][1] - self.UAV.xyz[1])
-
-            if self.state == 0:
-                self.UAV.set_v_2D_alt_lya(np.array([x_err*0.03, y_err*0.03]), -3)
-                if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
-                    self.state = 2
-            elif self.state == 1:
-                self.UAV.set_v_2D_alt_lya(np.array([x_err*0.03, -y_err*0.03]),-3)
-                if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
-                    self.state = 0
-            elif self.state == 2:
-                self.UAV.set_v_2D_alt_lya(np.array([-x_err*0.03, -y_err*0.03]), -3)
-                if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
-                    self.state = 3
-            elif self.state == 3:
-                self.UAV.set_v_2D_alt_lya(np.array([-x_err*0.03, y_err*0.03]), -3)
-                if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
-                    self.state = 1
-
-            self.UAV.step(dt)
+            self.fly()
             
             #LOGS:
-            #self.est_pos[it] = alg_pos
-            #self.gt_pos[it]  = self.UAV.xyz
-            if kalmanStarted or PFstarted or PKFstarted or method == 'NF':
-                self.Ed_log[it, :] = np.array([ self.get_dist_clean(alg_pos, self.UAV.xyz) ])
-                self.Ed2d_log[it, :] = np.array([ self.get_dist_clean(alg_pos[0:2], self.UAV.xyz[0:2]) ])
-                self.Edalt_log[it, :] = np.array([ self.get_dist_clean(alg_pos[2], self.UAV.xyz[2]) ])
-                self.Ed_vel_log[it, :] = np.array([ self.get_dist_clean(alg_pos, self.UAV.v_ned) ])
-                self.alg_log.xyz_h[it, :] = alg_pos
-            self.UAV_log.xyz_h[it, :] = self.UAV.xyz
-            self.UAV_log.att_h[it, :] = self.UAV.att
-            self.UAV_log.w_h[it, :] = self.UAV.w
-            self.UAV_log.v_ned_h[it, :] = self.UAV.v_ned
-            
+            self.log_step(it, alg_pos, kalmanStarted or PFstarted or PKFstarted or method == 'NF')
 
             it+=1
 
@@ -308,7 +297,145 @@ class pycopter:
                     pl.pause(0.001)
                     pl.draw()
 
+        return self.get_logs()
+
+    def range_epoch(self, t):
+        # t: simulation time of the ranges
+        self.UAV_agent.handle_range_msg(self.RA0.id, self.get_dist(self.UAV.xyz, self.uwb0.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA1.id, self.get_dist(self.UAV.xyz, self.uwb1.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA2.id, self.get_dist(self.UAV.xyz, self.uwb2.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA3.id, self.get_dist(self.UAV.xyz, self.uwb3.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA4.id, self.get_dist(self.UAV.xyz, self.uwb4.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA5.id, self.get_dist(self.UAV.xyz, self.uwb5.xyz), t)
+        self.UAV_agent.handle_range_msg(self.RA6.id, self.get_dist(self.UAV.xyz, self.uwb6.xyz), t)
+
+    def fly(self):
+        x_err = abs(self.wp[self.state][0] - self.UAV.xyz[0])
+        y_err = abs(self.wp[self.state][1] - self.UAV.xyz[1])
+
+        if self.state == 0:
+            self.UAV.set_v_2D_alt_lya(np.array([x_err*0.03, y_err*0.03]), -3)
+            if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
+                self.state = 2
+        elif self.state == 1:
+            self.UAV.set_v_2D_alt_lya(np.array([x_err*0.03, -y_err*0.03]),-3)
+            if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
+                self.state = 0
+        elif self.state == 2:
+            self.UAV.set_v_2D_alt_lya(np.array([-x_err*0.03, -y_err*0.03]), -3)
+            if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
+                self.state = 3
+        elif self.state == 3:
+            self.UAV.set_v_2D_alt_lya(np.array([-x_err*0.03, y_err*0.03]), -3)
+            if self.get_dist_clean(self.UAV.xyz, self.wp[self.state]) < 0.4:
+                self.state = 1
+
+        self.UAV.step(self.dt)
+
+    def log_step(self, it, alg_pos, started):
+        #self.est_pos[it] = alg_pos
+        #self.gt_pos[it]  = self.UAV.xyz
+        if started:
+            self.Ed_log[it, :] = np.array([ self.get_dist_clean(alg_pos, self.UAV.xyz) ])
+            self.Ed2d_log[it, :] = np.array([ self.get_dist_clean(alg_pos[0:2], self.UAV.xyz[0:2]) ])
+            self.Edalt_log[it, :] = np.array([ self.get_dist_clean(alg_pos[2], self.UAV.xyz[2]) ])
+            self.Ed_vel_log[it, :] = np.array([ self.get_dist_clean(alg_pos, self.UAV.v_ned) ])
+            self.alg_log.xyz_h[it, :] = alg_pos
+        self.UAV_log.xyz_h[it, :] = self.UAV.xyz
+        self.UAV_log.att_h[it, :] = self.UAV.att
+        self.UAV_log.w_h[it, :] = self.UAV.w
+        self.UAV_log.v_ned_h[it, :] = self.UAV.v_ned
+
+    def get_logs(self):
         alg_log = np.array([self.alg_log.xyz_h[:,0], self.alg_log.xyz_h[:,1], self.alg_log.xyz_h[:,2]])
         uav_log = np.array([self.UAV_log.xyz_h[:,0], self.UAV_log.xyz_h[:,1], self.UAV_log.xyz_h[:,2]])
         #print(self.Ed_log)
-        return [uav_log, alg_log, self.Ed_log, self.Ed2d_log, self.Edalt_log]
\ No newline at end of file
+        return [uav_log, alg_log, self.Ed_log, self.Ed2d_log, self.Edalt_log]
+
+
+def run_bank(copters, method):
+    # Runs len(copters) simulations in lockstep with one filter bank holding all their filters
+    # (ParticleFilterBank for 'PF'/'PF4', KFBank for 'KF'/'KF4', PKFBank for 'PKF'/'PKF4'), instead
+    # of calling pycopter.run once per simulation
+    M = len(copters)
+    kalman = method == 'KF' or method == 'KF4'
+    pkf = method == 'PKF' or method == 'PKF4'
+    use4 = method == 'PF4' or method == 'KF4' or method == 'PKF4'
+    use = 4
+    dt = copters[0].dt
+    bank = None
+    if kalman:
+        #Covariance diagnostics of the KF bank, every copter's cov_log is a view of its member
+        cov_log = CL.covarianceLog(copters[0].time.size, eig_every=50, M=M)
+        for m, c in enumerate(copters):
+            c.cov_log = cov_log.member(m)
+            c.eig_log = c.cov_log.eig
+
+    for it, t in enumerate(copters[0].time):
+        acc_err = np.array([c.acc_noise.normal(0, 0.012) for c in copters])
+        #HANDLE RANGE MEASUREMENTS:
+        if it % 50 == 0:
+            for c in copters:
+                c.range_epoch(it*dt)
+            if bank is not None and kalman:
+                #Position fixes of the geometric solution, members without a valid fix are masked out
+                z = np.array([c.UAV_agent.calc_pos_alg(use4=use4) for c in copters])
+                bank.update(z, mask=np.isfinite(z).all(axis=1))
+            elif bank is not None:
+                z = np.array([c.UAV_agent.get_ranges() for c in copters])
+                if use4:
+                    anchs, z = zip(*[c.UAV_agent.get_x_closest_nodes(c.UAV_agent.anchor_pos, z[m], x=use) for m, c in enumerate(copters)])
+                    bank.update(np.array(z), anchors=np.array(anchs))
+                else:
+                    bank.update(z)
+                if not pkf:
+                    bank.resample_if_needed()
+
+        #HANDLE KALMAN FILTER BANK
+        if kalman and bank is None and all(c.UAV.xyz[2] < -3 for c in copters):
+            bank = KFB.KFBank(np.array([c.UAV.xyz for c in copters]), np.array([c.UAV.v_ned for c in copters]), dt)
+            for c in copters:
+                c.R, c.Q = bank.get_return_vals()
+
+        #HANDLE PARTICLE KALMAN FILTER BANK
+        if pkf and bank is None and all(c.UAV.xyz[2] < -3 for c in copters):
+            anchors = copters[0].UAV_agent.predefine_ground_plane()
+            for c in copters:
+                c.UAV_agent.anchors = anchors
+            bank = PFB.PKFBank(M, np.array([c.UAV.xyz for c in copters]), np.array([c.UAV.v_ned for c in copters]), dt, anchors,
+                               rng=copters[0].streams.generator('pf_bank'))
+            for c in copters:
+                c.R, c.Q, c.n_of_particles, c.std_add = bank.get_return_vals()
+
+        #HANDLE PARTICLE FILTER BANK
+        if not kalman and not pkf and bank is None and all(c.UAV.xyz[2] < -3 for c in copters):
+            anchors = copters[0].UAV_agent.predefine_ground_plane()
+            for c in copters:
+                c.UAV_agent.anchors = anchors
+            bank = PFB.ParticleFilterBank(M, np.array([c.UAV.v_ned for c in copters]), dt, anchors, rng=copters[0].streams.generator('pf_bank'))
+            for c in copters:
+                c.n_of_particles, c.std_add = bank.get_return_vals()
+
+        if bank is not None and kalman:
+            bank.predict(np.array([c.UAV.acc for c in copters]) + acc_err[:, None])
+            alg_pos = bank.get_state()[:, 0:3]
+            cov_log.record(it, bank)
+        elif bank is not None and pkf:
+            alg_pos = bank.get_state()[:, 0:3].copy()
+            bank.predict(np.array([c.UAV.acc for c in copters]) + acc_err[:, None])
+        elif bank is not None:
+            alg_pos = bank.estimate()
+            bank.predict(np.array([c.UAV.acc for c in copters]) + acc_err[:, None])
+        else:
+            alg_pos = [c.UAV.xyz for c in copters]
+
+        #HANDLE UAV MOVEMENT AND LOGS:
+        for m, c in enumerate(copters):
+            c.fly()
+            c.log_step(it, alg_pos[m], bank is not None)
+
+        # Stop if crash
+        if any(c.UAV.crashed == 1 for c in copters):
+            break
+
+    return [c.get_logs() for c in copters], bank
\ No newline at end of file
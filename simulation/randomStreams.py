@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import zlib
+import numpy as np
+
+'''
+Independent, reproducible random streams for the simulation and the filters.
+
+Every component asks for its own stream by name. The streams are derived from one master
+seed through numpy's SeedSequence, keyed on the name (not on the order of creation), so
+adding a component never shifts the numbers another one sees, and two runs with the same
+seed are bit-for-bit identical (common random numbers across estimator versions).
+'''
+
+
+class blockNormal:
+    '''
+    Standard normals pre-generated in blocks of block_size. Scalar draws are served from the
+    block without a Generator call each, take(n) hands out views into it.
+    '''
+    def __init__(self, gen, block_size=4096):
+        self.gen = gen
+        self.block_size = block_size
+        self.buf = np.empty(block_size)
+        self.pos = block_size
+
+    def refill(self):
+        self.gen.standard_normal(out=self.buf)
+        self.pos = 0
+
+    def take(self, n):
+        # View of the next n standard normals, valid until the next call
+        if n > self.block_size:
+            return self.gen.standard_normal(n)
+        if self.pos + n > self.block_size:
+            self.refill()
+        v = self.buf[self.pos:self.pos+n]
+        self.pos += n
+        return v
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        if size is None:
+            if self.pos >= self.block_size:
+                self.refill()
+            v = self.buf[self.pos]
+            self.pos += 1
+            return loc + scale * v
+        return loc + scale * self.take(int(np.prod(size))).reshape(size)
+
+
+class randomStreams:
+    def __init__(self, seed=None):
+        # seed None draws fresh OS entropy, which is stored so the run can be repeated
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.streams = {}
+
+    def generator(self, name):
+        # Generator of the named stream (one per name, created on first use)
+        if name not in self.streams:
+            ss = np.random.SeedSequence(self.seed, spawn_key=(zlib.crc32(name.encode()),))
+            self.streams[name] = np.random.Generator(np.random.PCG64(ss))
+        return self.streams[name]
+
+    def block(self, name, block_size=4096):
+        return blockNormal(self.generator(name), block_size)
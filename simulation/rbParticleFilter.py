@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import math
+import numpy as np
+
+import particleFilter as PF
+
+
+class rbParticleFilter(PF.particleFilter):
+    '''
+    Rao-Blackwellized particle filter for the particleFilter motion model:
+
+        p' = p + v*dt + u*dt^2/2 + w_p,   w_p ~ N(0, sigma_pos^2)
+        v' = v + u*dt + w_v,              w_v ~ N(0, sigma_vel^2)
+
+    Only the 3-D position is sampled. Given a particle's position history its velocity is
+    linear-Gaussian, so every particle carries a closed-form Kalman mean for it. The velocity
+    variance only depends on dt and the noise levels, never on the data, so one scalar
+    variance is shared by all particles and all three axes.
+    particles[:, :3] are positions, particles[:, 3:] the per-particle velocity means.
+    The filter starts with n_init particles to cover the initialisation box and drops to N
+    at the first resample. Everything but predict and resample is particleFilter's.
+    '''
+    def __init__(self, start_vel, dt, anchors, option=0, N=300, n_init=1500, vel_var0=0.0, **kwargs):
+        self.n_target = N
+        if kwargs.get('adaptive') and kwargs.get('n_max') is None:
+            kwargs['n_max'] = n_init
+        super().__init__(start_vel, dt, anchors, option=option, N=max(N, n_init), **kwargs)
+
+        #Shared velocity variance (per axis) of the Rao-Blackwellized Kalman part
+        self.P = vel_var0
+
+    def alloc_buffers(self):
+        super().alloc_buffers()
+        #Only the positions are sampled
+        self.noise_buf = np.empty((self.N, 3), dtype=self.dtype)
+
+    def get_return_vals(self):
+        return self.n_target, self.upd_std_dev
+
+    def predict(self, u, v=None, dt=None):
+        # dt: elapsed time if it differs from self.dt, the noise levels are per self.dt and scale with sqrt(dt).
+        # A dt <= 0 is skipped.
+        if dt is not None and dt <= 0:
+            return
+        self.est_cache = None
+        if dt is None:
+            dt, scale = self.dt, 1.0
+        else:
+            scale = math.sqrt(dt / self.dt)
+        sigma_pos, sigma_vel = self.sigma_pos*scale, self.sigma_vel*scale
+        u = np.asarray(u, dtype=self.dtype)
+        pos, vel = self.particles[:, :3], self.particles[:, 3:]
+        step, noise = self.step_buf, self.noise_buf
+
+        #Sample p' from the transition with v marginalized out: N(p + m*dt + u*dt^2/2, dt^2*P + sigma_pos^2).
+        #This is the exact proposal, so the weights are unchanged.
+        S = dt*dt*self.P + sigma_pos**2
+        self.rng.standard_normal(out=noise, dtype=self.dtype)
+        noise *= np.sqrt(S)
+        np.multiply(vel, dt, out=step)
+        step += u * ((dt**2)/2)
+        step += noise
+        pos += step
+
+        #Kalman update of the velocity from the sampled increment (innovation = noise), then its time update
+        K = self.P * dt / S
+        noise *= K
+        vel += noise
+        vel += u * dt
+        self.P = self.P * sigma_pos**2 / S + sigma_vel**2
+
+    def predict_many(self, u_seq):
+        # The velocity variance changes every step, so there is no single-draw shortcut here
+        for u in np.asarray(u_seq, dtype=np.float64).reshape(-1, 3):
+            self.predict(u)
+
+    def resample(self):
+        #Velocity means travel with their positions, the shared variance is untouched
+        if self.adaptive or self.N == self.n_target:
+            super().resample()
+            return
+        #First resample after the wide initialisation: shrink to N
+        self.est_cache = None
+        indexes = np.empty(self.n_target, dtype=np.intp)
+        self.kern.systematic_resample(self.weights[:, 0], self.n_target, self.rng.random(), indexes)
+        particles = np.empty((self.n_target, 6), dtype=self.dtype)
+        self.kern.gather(self.particles, indexes, particles)
+        self.particles = particles
+        self.N = self.n_target
+        self.alloc_buffers()
+        self.weights = np.full((self.N, 1), 1.0/self.N, dtype=self.dtype)
+        self.log_w = np.full(self.N, -np.log(self.N), dtype=self.dtype)
+
+    def get_velocity(self):
+        w = self.weights[:, 0]
+        return np.dot(w, self.particles[:, 3:]) / w.sum()
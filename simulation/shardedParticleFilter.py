@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import sys
+import time
+import traceback
+
+import pfKernels
+
+'''
+Particle filter (particleFilter model, option 0) with the particles split into shards, one
+per worker process. Particles and log-weights live in shared memory, predict and update run
+locally in every worker, and resampling is distributed systematic resampling: the master only
+exchanges per-shard maxima/weight sums and the resulting prefix offsets, every worker then
+draws its own slice of the output from the global cumulative weights.
+'''
+
+
+def _worker(conn, names, N, lo, hi, dt, sigma_pos, sigma_vel, seed, backend):
+    shms = [shared_memory.SharedMemory(name=name) for name in names]
+    P = [np.ndarray((N, 6), dtype=np.float64, buffer=shms[0].buf),
+         np.ndarray((N, 6), dtype=np.float64, buffer=shms[1].buf)]
+    log_w = np.ndarray(N, dtype=np.float64, buffer=shms[2].buf)
+    cs = np.ndarray(N, dtype=np.float64, buffer=shms[3].buf)
+    rng = np.random.default_rng(seed)
+    kern = pfKernels.get_backend(backend)
+
+    cur = 0
+    n = hi - lo
+    noise = np.empty((n, 6))
+    step = np.empty((n, 3))
+    ll = np.empty(n)
+    sq_buf = np.empty(n)
+    dist_buf = np.empty((n, 0))
+    idx = np.empty(n, dtype=np.intp)
+
+    while True:
+        cmd, args = conn.recv()
+        if cmd == 'close':
+            break
+        #Every reply is ('ok', value), or ('error', traceback) when the command raised, so the master
+        #re-raises it instead of blocking on a dead worker
+        try:
+            if cmd == 'predict':
+                #args: input, elapsed time (None = dt) and the sqrt(elapsed/dt) noise scale
+                u, dt_k, scale = args
+                rng.standard_normal(out=noise)
+                kern.predict(P[cur][lo:hi], u, dt if dt_k is None else dt_k, sigma_pos*scale, sigma_vel*scale, noise, step)
+                reply = None
+            elif cmd == 'update':
+                a, z, scale = args
+                if dist_buf.shape[1] != a.shape[0]:
+                    dist_buf = np.empty((n, a.shape[0]))
+                kern.loglik(P[cur][lo:hi], a, z, scale, ll, dist_buf, sq_buf)
+                log_w[lo:hi] += ll
+                reply = log_w[lo:hi].max()
+            elif cmd == 'weights':
+                #Local cumulative sum of exp(log_w - global max), returns the shard's weight sum
+                np.exp(log_w[lo:hi] - args, out=cs[lo:hi])
+                np.cumsum(cs[lo:hi], out=cs[lo:hi])
+                reply = cs[hi-1]
+            elif cmd == 'offset':
+                cs[lo:hi] += args
+                reply = None
+            elif cmd == 'gather':
+                #Output slots lo..hi-1 of the systematic resample over the global cumulative sum
+                W, u0 = args
+                positions = (np.arange(lo, hi) + u0) * (W / N)
+                np.minimum(np.searchsorted(cs, positions, side='right'), N - 1, out=idx)
+                kern.gather(P[cur], idx, P[1-cur][lo:hi])
+                cur = 1 - cur
+                log_w[lo:hi] = 0.0
+                reply = None
+            elif cmd == 'estimate':
+                w = np.exp(log_w[lo:hi] - args)
+                reply = (np.dot(w, P[cur][lo:hi, :3]), w.sum(), np.dot(w, w))
+            else:
+                raise ValueError("Unknown command: " + str(cmd))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+            continue
+        conn.send(('ok', reply))
+
+    del P, log_w, cs
+    for shm in shms:
+        shm.close()
+    conn.send(('ok', None))
+
+
+class shardedParticleFilter:
+    def __init__(self, start_vel, dt, anchors, option=0, N=25000, n_workers=None, ess_frac=None, rng=None, backend=None):
+        self.option = option
+        self.N = N
+        self.upd_std_dev = 0.04
+        self.dt = dt
+        self.t = None # time of the last predict_to
+        self.anchors = anchors
+        self.ess_frac = ess_frac
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.sigma_pos, self.sigma_vel = 0.0005, 0.00002
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.cur = 0
+        self.max_log_w = 0.0
+        self.ess = float(N)
+        self.est_cache = None
+
+        #Shared memory: two particle buffers (resampling gathers from one into the other), log-weights, cumulative sums
+        sizes = [N*6*8, N*6*8, N*8, N*8]
+        self.shms = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        self.P = [np.ndarray((N, 6), dtype=np.float64, buffer=self.shms[0].buf),
+                  np.ndarray((N, 6), dtype=np.float64, buffer=self.shms[1].buf)]
+        self.log_w = np.ndarray(N, dtype=np.float64, buffer=self.shms[2].buf)
+        self.log_w[:] = 0.0
+
+        particles = self.P[0]
+        particles[:, 0] = self.rng.uniform(-4.0, 4.0, size=N)
+        particles[:, 1] = self.rng.uniform(-4.0, 4.0, size=N)
+        particles[:, 2] = self.rng.uniform(-3.5, 0.5, size=N)
+        particles[:, 3:] = start_vel
+
+        bounds = np.linspace(0, N, self.n_workers + 1).astype(int)
+        names = [shm.name for shm in self.shms]
+        self.conns = []
+        self.workers = []
+        for s in range(self.n_workers):
+            parent, child = mp.Pipe()
+            p = mp.Process(target=_worker, args=(child, names, N, bounds[s], bounds[s+1], dt, self.sigma_pos, self.sigma_vel,
+                                                 int(self.rng.integers(2**63)), backend), daemon=True)
+            p.start()
+            self.conns.append(parent)
+            self.workers.append(p)
+
+    def call(self, cmd, args=None):
+        # Same command to every shard, returns the per-shard replies
+        for conn in self.conns:
+            conn.send((cmd, args))
+        return self.replies()
+
+    def replies(self):
+        # One reply from every shard (all are read, so the pipes stay in step), raises the first worker error
+        replies = [conn.recv() for conn in self.conns]
+        for status, value in replies:
+            if status == 'error':
+                raise RuntimeError("Particle filter shard failed:\n" + value)
+        return [value for status, value in replies]
+
+    def get_return_vals(self):
+        return self.N, self.upd_std_dev
+
+    def predict(self, u, v=None, dt=None):
+        # dt: elapsed time if it differs from self.dt, the noise levels are per self.dt and scale with sqrt(dt).
+        # A dt <= 0 is skipped.
+        if dt is not None and dt <= 0:
+            return
+        self.est_cache = None
+        scale = 1.0 if dt is None else np.sqrt(dt / self.dt)
+        self.call('predict', (np.asarray(u, dtype=np.float64), dt, scale))
+
+    def predict_to(self, u, t):
+        # Timestamp-driven predict from the time of the previous call to t (the first call only sets the time).
+        # A t at or before the filter's time is skipped and does not move the time back.
+        if self.t is None:
+            self.t = t
+        elif t > self.t:
+            self.predict(u, dt=t - self.t)
+            self.t = t
+
+    def update(self, z, anchs=0, use4=False):
+        self.est_cache = None
+        if use4:
+            self.anchors = anchs
+        a = np.ascontiguousarray(self.anchors, dtype=np.float64).reshape(-1, 3)
+        a, z = pfKernels.finite_ranges(a, np.ascontiguousarray(np.asarray(z, dtype=np.float64)[:a.shape[0]]))
+        if len(z) == 0:
+            return
+        self.max_log_w = max(self.call('update', (a, z, 0.5 / (self.upd_std_dev**2))))
+
+    def neff(self):
+        parts = self.call('estimate', self.max_log_w)
+        W = sum(p[1] for p in parts)
+        self.ess = W*W / sum(p[2] for p in parts)
+        return self.ess
+
+    def get_ess(self):
+        return self.ess
+
+    def resample_if_needed(self):
+        ess = self.neff()
+        if self.ess_frac is not None and ess >= self.ess_frac * self.N:
+            return False
+        self.resample()
+        return True
+
+    def resample(self):
+        self.est_cache = None
+        sums = self.call('weights', self.max_log_w)
+        W = float(np.sum(sums))
+        if not W > 0.0 or not np.isfinite(W):
+            raise ValueError("Particle weights are NaN or all zero")
+        offsets = np.concatenate(([0.0], np.cumsum(sums)[:-1]))
+        for conn, offset in zip(self.conns, offsets):
+            conn.send(('offset', offset))
+        self.replies()
+        self.call('gather', (W, self.rng.random()))
+        self.cur = 1 - self.cur
+        self.max_log_w = 0.0
+
+    def estimate(self, method=None):
+        if self.est_cache is None:
+            parts = self.call('estimate', self.max_log_w)
+            self.est_cache = sum(p[0] for p in parts) / sum(p[1] for p in parts)
+        return self.est_cache
+
+    def get_particles(self):
+        return self.P[self.cur]
+
+    def close(self):
+        if not self.workers:
+            return
+        self.call('close')
+        for p in self.workers:
+            p.join()
+        self.workers = []
+        del self.P, self.log_w
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+if __name__ == "__main__":
+    # Scaling: python shardedParticleFilter.py [N] [max_workers]
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    d = 4.0
+    dy = d * (np.sqrt(3)/2)
+    anchors = np.array([ [0.0, 0.0, 0.10], [d, 0.0, 0.05], [d/2, dy, 0.0], [d/2, -dy, 0.0],
+                         [-(d/2), dy, 0.0], [-d, 0.0, 0.05], [-(d/2), -dy, 0.0] ])
+    z = np.linalg.norm(anchors - np.array([0.5, 0.3, -1.0]), axis=1)
+    repeats = 20
+
+    print("N =", N, " cores available:", os.cpu_count())
+    print("%8s %12s %12s %12s" % ("workers", "predict[ms]", "update[ms]", "resamp[ms]"))
+    for n_workers in range(1, max_workers + 1):
+        pf = shardedParticleFilter(np.zeros(3), 0.01, anchors, N=N, n_workers=n_workers, rng=np.random.default_rng(0))
+        pf.predict(np.zeros(3)); pf.update(z); pf.resample() #warm-up, includes JIT compilation in the workers
+        t = np.zeros(3)
+        for _ in range(repeats):
+            prev_t = time.perf_counter(); pf.predict(np.zeros(3)); t[0] += time.perf_counter() - prev_t
+            prev_t = time.perf_counter(); pf.update(z); t[1] += time.perf_counter() - prev_t
+            prev_t = time.perf_counter(); pf.resample(); t[2] += time.perf_counter() - prev_t
+        pf.close()
+        print("%8d %12.3f %12.3f %12.3f" % ((n_workers,) + tuple(t / repeats * 1e3)))
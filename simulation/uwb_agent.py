@@ -9,8 +9,11 @@ import sympy as symp
 import serial
 import localization as lx
 import particleFilter as PF
+import rbParticleFilter as RBPF
+import shardedParticleFilter as SPF
 import kalmanFilter as KF
-import time
+import multilateration as ML
+import profiler as PR
 
 '''
 Position Rules:
@@ -21,16 +24,23 @@ ID = 3: Always posetive in x-component and negative in y-component
 ID = 10: Always the UAV
 '''
 
+MAX_NODES = 16 #Node IDs 0..MAX_NODES-1
+ANCHORS = slice(0, 7) #Anchor IDs 0..6
+#Profiler spans reported by get_time_vals for every method family
+TIME_SPANS = {'NF': ['geo'], 'KF': ['kf_predict', 'kf_upd'], 'PF': ['pf_predict', 'pf_upd', 'pf_resamp'],
+              'PKF': ['pkf_predict', 'pkf_upd']}
+
 class uwb_agent:
-    def __init__(self, ID, d=None):
+    def __init__(self, ID, d=None, profile=True):
         self.id = int(ID)
         self.d = d
 
-        self.M = np.array([self.id]) #Modules
-        self.N = np.array([]) #Neigbours
-        self.E = np.array([0]) #
-        self.pairs = np.empty((0,3))
+        #RANGE TABLE: last range between every two node IDs, when it was received and whether it was ever received
+        self.range_table = np.full((MAX_NODES, MAX_NODES), np.nan)
+        self.range_time = np.full((MAX_NODES, MAX_NODES), -np.inf)
+        self.range_valid = np.zeros((MAX_NODES, MAX_NODES), dtype=bool)
         self.poslist = np.array([])
+        self.anchors = self.predefine_ground_plane()
 
         #MSE:
         self.prev_val = np.array([1.5, 2.0, 0.1])
@@ -38,97 +48,131 @@ class uwb_agent:
         #FILTERS:
         self.KF_started = False
 
-        #TIME HANDLERS:
-        self.time_taken_pf_upd = 0.0
-        self.time_instanes_pf_upd = 0
-        self.time_taken_pf_predict = 0.0
-        self.time_instanes_pf_predict = 0
-        self.time_taken_pf_resamp = 0.0
-        self.time_instanes_pf_resamp = 0
+        #TIME HANDLERS (profile=False keeps the spans as no-ops):
+        self.prof = PR.profiler(enabled=profile)
 
-        self.time_taken_kf_upd = 0.0
-        self.time_instanes_kf_upd = 0
-        self.time_taken_kf_predict = 0.0
-        self.time_instanes_kf_predict = 0
+    # ***************** ANCHOR LAYOUT *****************
+    @property
+    def anchors(self):
+        return self.anchor_pos
 
-        self.time_taken_geo = 0.0
-        self.time_instanes_geo = 0
+    @anchors.setter
+    def anchors(self, anchors):
+        # Assigning a new layout refactors the cached multilateration solvers
+        self.anchor_pos = np.array(anchors, dtype=np.float64).reshape(-1, 3)
+        self.ml = ML.multilateration(self.anchor_pos)
+        self.ml4 = self.ml.subset((0, 1, 2, 3))
 
     # ***************** RETURN TIME VALUES ************************
     def get_time_vals(self, method):
-        if method == 'NF' or method == 'NF4':
-            return ((self.time_taken_geo) / (self.time_instanes_geo))
-        elif method == 'KF' or method == 'KF4':
-            return [((self.time_taken_kf_predict) / (self.time_instanes_kf_predict)) ,  ((self.time_taken_kf_upd) / (self.time_instanes_kf_upd))]
-        elif method == 'PF' or method == 'PF4' or method == 'PF2':
-            return [((self.time_taken_pf_predict) / (self.time_instanes_pf_predict)) ,  ((self.time_taken_pf_upd) / (self.time_instanes_pf_upd)) , ((self.time_taken_pf_resamp) / (self.time_instanes_pf_resamp))]
-        elif method == 'PKF' or method == 'PKF4':
-            pass
+        # Mean time per call [s] of the spans of the method (NF: geo, KF/EKF: predict and update,
+        # PF/RBPF: predict, update and resampling, PKF: predict and update), see prof for the tails
+        family = method.rstrip('0123456789')
+        if family[0:2] == 'RB':
+            family = family[2:]
+        if family[0:2] == 'EK':
+            family = family[1:]
+        vals = [self.prof.mean(name) for name in TIME_SPANS[family]]
+        return vals[0] if family == 'NF' else vals
 
     # ***************** PARTICLE FILTER FUNCTIONS *****************
-    def startPF(self, start_vel, dt, option=0):
+    def startPF(self, start_vel, dt, option=0, log_weights=False, ess_frac=None, adaptive=False, n_min=300, n_max=None, est_method='mean', rao_blackwell=False, rng=None, sharded=0):
         self.anchors = self.predefine_ground_plane()
-        self.PF = PF.particleFilter(dt=dt, start_vel=start_vel, anchors=self.anchors, option=option)
+        if sharded:
+            #Particles sharded over 'sharded' worker processes (meant for the 25000+ particle settings)
+            self.PF = SPF.shardedParticleFilter(dt=dt, start_vel=start_vel, anchors=self.anchors, option=option, n_workers=sharded,
+                                                ess_frac=ess_frac, rng=rng)
+            return self.PF.get_return_vals()
+        if rao_blackwell:
+            #Particles over position only, Kalman over velocity
+            self.PF = RBPF.rbParticleFilter(dt=dt, start_vel=start_vel, anchors=self.anchors, option=option, log_weights=log_weights,
+                                            ess_frac=ess_frac, adaptive=adaptive, n_min=n_min, n_max=n_max, est_method=est_method, rng=rng)
+            return self.PF.get_return_vals()
+        self.PF = PF.particleFilter(dt=dt, start_vel=start_vel, anchors=self.anchors, option=option, log_weights=log_weights, ess_frac=ess_frac,
+                                    adaptive=adaptive, n_min=n_min, n_max=n_max, est_method=est_method, rng=rng)
         return self.PF.get_return_vals()
 
-    def PFpredict(self, u, v=None):
-        prev_t = time.time()
-        self.PF.predict(u)
-        self.time_taken_pf_predict += time.time() - prev_t
-        self.time_instanes_pf_predict += 1
+    @PR.timed('pf_predict')
+    def PFpredict(self, u, v=None, dt=None):
+        if dt is None:
+            self.PF.predict(u)
+        else:
+            self.PF.predict(u, dt=dt)
 
     def PFupdate(self, use4, use):
-        prev_t = time.time()
-        z = self.get_ranges()
-        n=0
-        if use4:
-            a,b,c,d,e,f,g = self.anchors
-            n = [a,b,c,d,e,f,g]
-            n,z = self.get_x_closest_nodes(n, z, x=use)
-
-        self.PF.update(z=z, anchs=n, use4=use4)
-        self.time_taken_pf_upd += time.time() - prev_t
-        self.time_instanes_pf_upd += 1
-
-        prev_t = time.time()
-        self.PF.resample()
-        self.time_taken_pf_resamp += time.time() - prev_t
-        self.time_instanes_pf_resamp += 1
+        with self.prof.span('pf_upd'):
+            z = self.get_ranges()
+            n=0
+            if use4:
+                n,z = self.get_x_closest_nodes(self.anchor_pos, z, x=use)
+
+            self.PF.update(z=z, anchs=n, use4=use4)
+
+        with self.prof.span('pf_resamp'):
+            self.PF.resample_if_needed()
         
     def getPFpos(self):
         return self.PF.estimate()
 
+    def get_PF_ess(self):
+        return self.PF.get_ess()
+
     def get_particles(self):
         return self.PF.get_particles()
 
     # ***************** KALMAN FILTER FUNCTIONS *****************
-    def startKF(self, xyz, v_ned, dt, option=0):
-        self.UAV_KF = KF.KF(xyz, v_ned, dt, option=option)
+    def startKF(self, xyz, v_ned, dt, option=0, fast=None, sqrt=False, dtype=np.float64, steady_state=False, sequential=False):
+        if sqrt:
+            #Square-root (Cholesky) form, also usable in float32. It has no block, steady-state or sequential mode
+            if steady_state or sequential or fast is not None:
+                raise ValueError("sqrt=True can not be combined with fast, steady_state or sequential")
+            self.UAV_KF = KF.SRKF(xyz, v_ned, dt, option=option, dtype=dtype)
+        else:
+            self.UAV_KF = KF.KF(xyz, v_ned, dt, option=option, fast=fast if fast is not None else True,
+                                steady_state=steady_state, sequential=sequential)
         self.KF_started = True
         return self.UAV_KF.get_return_vals()
 
-    def KFpredict(self, acc):
-        prev_t = time.time()
-        self.UAV_KF.predict(acc)
-        self.time_taken_kf_predict += time.time() - prev_t
-        self.time_instanes_kf_predict += 1
+    @PR.timed('kf_predict')
+    def KFpredict(self, acc, dt=None):
+        if dt is None:
+            self.UAV_KF.predict(acc)
+        else:
+            self.UAV_KF.predict(acc, dt=dt)
 
     def get_kf_state(self):
         return self.UAV_KF.get_state()[0:3]
 
+    def startEKF(self, xyz, v_ned, dt, option=0):
+        #Range-only EKF, updated with the raw ranges instead of the calc_pos_alg fix
+        self.anchors = self.predefine_ground_plane()
+        self.UAV_KF = KF.EKF(xyz, v_ned, dt, self.anchors, option=option)
+        return self.UAV_KF.get_return_vals()
+
+    @PR.timed('kf_upd')
+    def EKFupdate(self, use4, use):
+        z = self.get_ranges()
+        n=0
+        if use4:
+            n,z = self.get_x_closest_nodes(self.anchor_pos, z, x=use)
+
+        self.UAV_KF.update(z=z, anchs=n, use4=use4)
+
 
     # ***************** KALMAN PARTICLE FILTER FUNCTIONS *****************
-    def startPKF(self, acc, dt, xyz, v_ned, option=1):
+    def startPKF(self, acc, dt, xyz, v_ned, option=1, rng=None):
         #print("STARTING PARTICLE KALMAN FILTER")
-        pf_val1, pf_val2 = self.startPF(v_ned, dt, option=option)
+        pf_val1, pf_val2 = self.startPF(v_ned, dt, option=option, rng=rng)
         kf_val1, kf_val2 = self.startKF(xyz, v_ned, dt, option=1)
         return kf_val1, kf_val2, pf_val1, pf_val2
 
+    @PR.timed('pkf_predict')
     def predictPKF(self, u):
         self.UAV_KF.predict(u)
         kf_v = self.get_kf_state()[3:6]
         self.PFpredict(u=u, v=kf_v)
 
+    @PR.timed('pkf_upd')
     def updatePKF(self, use4, use):
         self.PFupdate(use4, use)
         pf_pos = self.getPFpos()
@@ -140,33 +184,42 @@ class uwb_agent:
 
 
     # ***************** HANDLE INPUT FUNCTIONS *****************
-    def handle_range_msg(self, Id, range):
-        self.add_nb_module(Id, range)
-
-    def handle_other_msg(self, Id1, Id2, range):
-        self.add_pair(Id1, Id2, range)
-
-    def add_nb_module(self, Id, range):
-        if not any(x == Id for x in self.N):
-            self.N = np.append(self.N, Id)
-            self.E = np.append(self.E, range)
-            self.M = np.append(self.M, Id)
-            self.pairs = np.append(self.pairs, np.array([[self.id, Id, range]]),axis=0)
-        else:
-            self.E[Id] = range
-            for pair in self.pairs:
-                if any(x == Id for x in pair) and any(x == self.id for x in pair):
-                    pair[2] = range
-
-    def add_pair(self, Id1, Id2, range):
-        pair_present = False
-        for i, pair in enumerate(self.pairs):
-            if (pair[0] == Id1 and pair[1] == Id2) or (pair[1] == Id1 and pair[0] == Id2):
-                self.pairs[i][2] = range
-                pair_present = True
-
-        if not pair_present:
-            self.pairs = np.append(self.pairs, np.array([[Id1, Id2, range]]),axis=0)
+    # t: time the range was measured, in the caller's clock (the simulation time in pycopter)
+    def handle_range_msg(self, Id, range, t):
+        self.add_nb_module(Id, range, t)
+
+    def handle_other_msg(self, Id1, Id2, range, t):
+        self.add_pair(Id1, Id2, range, t)
+
+    def add_nb_module(self, Id, range, t):
+        self.add_pair(self.id, Id, range, t)
+
+    def add_pair(self, Id1, Id2, range, t):
+        # O(1) write of both (Id1, Id2) and (Id2, Id1)
+        Id1, Id2 = int(Id1), int(Id2)
+        if not (0 <= Id1 < MAX_NODES and 0 <= Id2 < MAX_NODES):
+            raise ValueError("Node IDs must be in 0..%d, got %d and %d" % (MAX_NODES - 1, Id1, Id2))
+        self.range_table[Id1, Id2] = self.range_table[Id2, Id1] = range
+        self.range_time[Id1, Id2] = self.range_time[Id2, Id1] = t
+        self.range_valid[Id1, Id2] = self.range_valid[Id2, Id1] = True
+
+    # Views of the range table in the form of the old neighbour/pair arrays
+    @property
+    def N(self): #Neigbours
+        return np.flatnonzero(self.range_valid[self.id])
+
+    @property
+    def M(self): #Modules
+        return np.concatenate(([self.id], self.N))
+
+    @property
+    def E(self): #Ranges to the neighbours, indexed by ID
+        return self.range_table[self.id]
+
+    @property
+    def pairs(self):
+        i, j = np.nonzero(np.triu(self.range_valid))
+        return np.column_stack((i, j, self.range_table[i, j]))
 
     # ***************** UTILITY FUNCTIONS *****************
     def calc_dist(self, p1, p2):
@@ -175,25 +228,14 @@ class uwb_agent:
     def clean_cos(self, cos_angle):
         return min(1,max(cos_angle,-1))
 
-    def get_ranges(self):
-        r = np.empty(7)
-        for i, pair in enumerate(self.pairs):
-            if pair[0] == 10:
-                if pair[1] == 0:
-                    r[0] = pair[2]
-                elif pair[1] == 1:
-                    r[1] = pair[2]
-                elif pair[1] == 2:
-                    r[2] = pair[2]
-                elif pair[1] == 3:
-                    r[3] = pair[2]
-                elif pair[1] == 4:
-                    r[4] = pair[2]
-                elif pair[1] == 5:
-                    r[5] = pair[2]
-                elif pair[1] == 6:
-                    r[6] = pair[2]
-        return r
+    def get_ranges(self, ids=ANCHORS):
+        # Last ranges from this node to the nodes in ids (NaN if never received). A view into the range
+        # table for a slice of IDs (default: the anchors), a copy for a list of IDs
+        return self.range_table[self.id, ids]
+
+    def get_range_info(self, ids=ANCHORS):
+        # Receive times and validity flags that go with get_ranges(ids)
+        return self.range_time[self.id, ids], self.range_valid[self.id, ids]
 
     def predefine_ground_plane(self):
         d = 4.0
@@ -212,15 +254,9 @@ class uwb_agent:
         return A, B, C, D, E, F, G
 
     def get_x_closest_nodes(self, n, r, x=4):
-        idx = np.argsort(r)
-        new_r = np.empty(len(r))
-        new_n = np.empty((len(n),3))
-        #print("array before sort(r): \n", r, "\n(n): \n", n)
-        for i in range(len(r-1)):
-            new_r[i] = r[idx[i]]
-            new_n[i] = n[idx[i]]
-        #print("array after sort(r): \n", new_r[0:x], "\n(n): \n", new_n[0:x])
-        return new_n[0:x], new_r[0:x]
+        # The x anchors of n with the shortest ranges r and their ranges (in anchor order)
+        idx = self.ml.select(r, x)
+        return np.asarray(n)[idx], np.asarray(r)[idx]
 
     def define_ground_plane(self):
         '''
@@ -269,60 +305,46 @@ class uwb_agent:
 
 
     # ***************** POSITION ESTIMATION FUNCTIONS *****************
-    def calc_pos_alg(self, use4):
-        prev_t = time.time()
-        #use4 = False
-        if use4:
-            nodes = 4
-        else:
-            nodes = 7
-        a,b,c,d,e,f,g = self.predefine_ground_plane() #A, B, C, D, E, F, G
-        x = np.array([ a[0], b[0], c[0], d[0], e[0], f[0], g[0] ])
-        y = np.array([ a[1], b[1], c[1], d[1], e[1], f[1], g[1] ])
-        z = np.array([ a[2], b[2], c[2], d[2], e[2], f[2], g[2] ])
-
-        A = np.zeros((nodes-1, 3))
-        B = np.zeros(nodes-1)
-
-        X = np.zeros(3)
-
-        q = np.zeros(nodes)
-        r = self.get_ranges()
-        n = np.array([a,b,c,d,e,f,g])
-
-        #if use4:
-            #n, r = self.get_x_closest_nodes(n,r)
-
-        for i in range(nodes):
-            q[i] = (r[i]**2 - x[i]**2 - y[i]**2 - z[i]**2) / 2
-
-        
-        for i in range(nodes-1):
-            #print i 
-            A[i][0] = x[0] - x[i+1]
-            A[i][1] = y[0] - y[i+1]
-            A[i][2] = z[0] - z[i+1]
-
-            B[i] = q[i+1] - q[0]
-
-        if use4:
-            X = np.dot(np.linalg.inv(A), B)
-        else:
-            X = np.linalg.lstsq(A, B, rcond=None)[0]
-        
-        self.time_taken_geo += time.time() - prev_t
-        self.time_instanes_geo += 1
+    def calc_pos_alg(self, use4, select=None):
+        #use4: 4 anchors exactly, otherwise all 7 in the least-squares sense. select picks the 4: None = the
+        #first 4 (A, B, C, D), 'closest' = the 4 shortest ranges, 'gdop' = lowest GDOP at the 7-anchor fix.
+        #Anchors never heard from (NaN range) are left out, without 4 usable anchors the fix is NaN
+        with self.prof.span('geo'):
+            r = self.get_ranges()
+            idx = np.flatnonzero(np.isfinite(r))
+            if len(idx) == len(r):
+                if use4 and select is None:
+                    X = self.ml4.solve(r[0:4])
+                elif use4:
+                    pos = self.ml.solve(r) if select == 'gdop' else None
+                    X = self.ml.solve_subset(r, 4, pos)
+                else:
+                    X = self.ml.solve(r)
+            elif len(idx) < 4 or self.ml.subset(idx).rank < 3:
+                X = np.full(3, np.nan)
+            else:
+                if use4 and select is None:
+                    idx = idx[0:4]
+                elif use4:
+                    pos = self.ml.subset(idx).solve(r[idx]) if select == 'gdop' else None
+                    idx = self.ml.select(r, 4, pos)
+                X = self.ml.subset(idx).solve(r[idx])
 
         if self.KF_started:
-            prev_t = time.time()
-            self.UAV_KF.update(z=X)
-            self.time_taken_kf_upd += time.time() - prev_t
-            self.time_instanes_kf_upd += 1
+            if np.isfinite(X).all():
+                with self.prof.span('kf_upd'):
+                    self.UAV_KF.update(z=X)
             return self.UAV_KF.get_state()[0:3]
         else:
             return X
 
 
+    def solve_positions(self, ranges, mask=None):
+        # Offline batch of calc_pos_alg over a range log: ranges (T,7) to the anchors -> positions (T,3),
+        # range residuals (T,7) and GDOP (T,); missing ranges are NaN or masked out
+        return self.ml.solve_positions(ranges, mask)
+
+
     def mse(self, x, c, r):
         mse = 0.0
         for location, distance in zip(c, r):
@@ -331,15 +353,9 @@ class uwb_agent:
         return mse / len(c)
 
     def calc_pos_MSE(self):
-        c = self.predefine_ground_plane()
-        c = c[0:3]
-        r = self.get_ranges()
-        r = r[0:3]
-
-        x0 = self.prev_val
-
-        res = scipy.optimize.minimize(self.mse, x0, args=(c, r), method='SLSQP')
-        self.prev_val = res.x
+        # Nonlinear least-squares fit of the ranges to the first 3 anchors, warm-started from the last solution
+        r = self.get_ranges()[0:3]
+        self.prev_val = self.ml.subset((0, 1, 2)).solve_nls(r, self.prev_val)
 
         return [self.prev_val[0], self.prev_val[1], -(abs(self.prev_val[2]))]
 
@@ -16,14 +16,16 @@ import sympy as symp
 import scipy as scip
 import serial
 import localization as lx
+import multilateration as ML
 
 
 PI = 3.14159265359
 DEBUG = False
 
 class KF:
-    def __init__(self, xyz, v_ned):
+    def __init__(self, xyz, v_ned, sequential=False):
         self.dt = 0.2
+        self.sequential = sequential
         n_of_nodes = 1
 
         dim_x = 6
@@ -97,6 +99,9 @@ class KF:
 
     def update(self, z):
         self.calc_H()
+        if self.sequential:
+            self.update_sequential(z)
+            return
 
         PHT = np.dot(self.P, self.H.T)
         S = np.linalg.inv( np.dot(self.H, PHT) + self.R )
@@ -111,11 +116,28 @@ class KF:
         #self.P = self.P - (np.dot( KH, self.P ))
         #print("New Eigin P: ", np.linalg.eig(self.P)[0][0:3] )
 
+    def update_sequential(self, z):
+        # One scalar update per row of H (R diagonal): a division instead of inv(), rows with a
+        # non-finite range are skipped
+        z = np.reshape(z, (-1,))
+        for j in np.flatnonzero(np.isfinite(z)):
+            h = self.H[j]
+            PHT, HP = np.dot(self.P, h), np.dot(h, self.P)
+            self.K = PHT / (np.dot(h, PHT) + self.R[j][j])
+            self.x = self.x + self.K * (z[j] - np.dot(h, self.x))
+            self.P = self.P - np.outer(self.K, HP)
+
     def get_state(self):
         return self.x
 
     def get_plot_data(self):
-        return np.sqrt( np.linalg.eig(self.P)[0][0:3] )
+        # Principal standard deviations of the position
+        return np.sqrt( np.linalg.eigvalsh(self.P[0:3, 0:3]) )
+
+    def get_diagnostics(self):
+        # Position standard deviations, trace and log-determinant of P, without an eigendecomposition
+        d = np.diag(self.P)
+        return np.sqrt(d[0:3]), d.sum(), np.linalg.slogdet(self.P)[1]
 
 
 class uwb_agent:
@@ -131,6 +153,7 @@ class uwb_agent:
 
         self.val = np.array([])
         self.prev_val = np.array([1.5, 2.0, 0.1])
+        self.ml = None
 
         self.poslist = np.array([])
 
@@ -138,8 +161,8 @@ class uwb_agent:
 
         self.KF_started = False
 
-    def startKF(self, xyz, v_ned):
-        self.UAV_KF = KF(xyz, v_ned)
+    def startKF(self, xyz, v_ned, sequential=False):
+        self.UAV_KF = KF(xyz, v_ned, sequential=sequential)
         self.kf_range_in = np.array([0,0,0])
         self.range_check = np.array([False,False,False])
         self.KF_started = True
@@ -290,10 +313,12 @@ class uwb_agent:
                 elif pair[1] == 6:
                     r[6] = pair[2]
 
-        x0 = self.prev_val
-
-        res = scip.optimize.minimize(self.mse, x0, args=(c, r), method='SLSQP')
-        self.prev_val = res.x
+        #Fit to the anchors heard so far (None -> NaN), warm-started from the last solution
+        r = np.array(r, dtype=np.float64)
+        idx = np.flatnonzero(np.isfinite(r))
+        if self.ml is None:
+            self.ml = ML.multilateration(c)
+        self.prev_val = self.ml.subset(idx).solve_nls(r[idx], self.prev_val)
 
         return [self.prev_val[0], self.prev_val[1], -(abs(self.prev_val[2]))]
 